@@ -0,0 +1,41 @@
+import numpy as np
+
+# pinhole camera model shared by the python nodes.
+# built once from the camera's projection matrix (CameraInfo.P) and image size. the per pixel viewing rays
+# are precomputed, so back-projecting depth pixels is a gather and a multiply
+class CameraModel:
+    def __init__ (self, proj_matrix, width, height):
+        self.proj_matrix = np.array(proj_matrix, dtype=float).reshape(3, 4)
+        self.width = int(width)
+        self.height = int(height)
+
+        self.fx = self.proj_matrix[0, 0]
+        self.fy = self.proj_matrix[1, 1]
+        self.cx = self.proj_matrix[0, 2]
+        self.cy = self.proj_matrix[1, 2]
+
+        # x / z of the ray through each pixel column and y / z of the ray through each pixel row
+        self.ray_x = (np.arange(self.width) - self.cx) / self.fx
+        self.ray_y = (np.arange(self.height) - self.cy) / self.fy
+
+    @classmethod
+    def from_camera_info (cls, info):
+        return cls(list(info.P), info.width, info.height)
+
+    # rows, cols: pixel indices; z: depth of each pixel (m)
+    # returns N*3 points in the camera frame
+    def back_project (self, rows, cols, z):
+        return np.vstack((self.ray_x[cols] * z, self.ray_y[rows] * z, z)).T
+
+    # points: N*3 in the camera frame
+    # returns the (unclamped) image coordinates us, vs
+    def project (self, points):
+        image_coords = np.matmul(points, self.proj_matrix[:, :3].T) + self.proj_matrix[:, 3]
+        return image_coords[:, 0] / image_coords[:, 2], image_coords[:, 1] / image_coords[:, 2]
+
+    # image coordinates converted to pixel indices and clamped to the image (on both sides), safe for indexing
+    def project_to_pixels (self, points):
+        us, vs = self.project(points)
+        us = np.clip(np.nan_to_num(np.floor(us)), 0, self.width-1).astype(int)
+        vs = np.clip(np.nan_to_num(np.floor(vs)), 0, self.height-1).astype(int)
+        return us, vs
@@ -0,0 +1,140 @@
+import cv2
+import numpy as np
+
+from scipy import interpolate
+
+from utils import extract_connected_skeleton, mask_bounding_box, estimate_pixel_width, select_img_scale, refine_chains
+from timing import Timer
+
+# initial node set computation without any ROS dependency.
+# used by the init_tracker node (initialize.py) and by utils/batch_initialize.py for offline runs
+
+def color_thresholding (hsv_image, cur_depth):
+    # --- rope blue ---
+    lower = (90, 90, 60)
+    upper = (130, 255, 255)
+    mask_dlo = cv2.inRange(hsv_image, lower, upper).astype('uint8')
+
+    # --- tape red ---
+    lower = (130, 60, 40)
+    upper = (255, 255, 255)
+    mask_red_1 = cv2.inRange(hsv_image, lower, upper).astype('uint8')
+    lower = (0, 60, 40)
+    upper = (10, 255, 255)
+    mask_red_2 = cv2.inRange(hsv_image, lower, upper).astype('uint8')
+    mask_marker = cv2.bitwise_or(mask_red_1.copy(), mask_red_2.copy()).astype('uint8')
+
+    # combine masks
+    mask = cv2.bitwise_or(mask_marker.copy(), mask_dlo.copy())
+
+    # filter mask base on depth values
+    mask[cur_depth < 0.58*1000] = 0
+
+    return mask
+
+# removes consecutive duplicate points and keeps at most max_pts points, evenly spread over the chain
+def subsample_chain (pts, max_pts=200):
+    pts = pts[np.concatenate(([True], np.any(np.diff(pts, axis=0) != 0, axis=1)))]
+    if len(pts) > max_pts:
+        pts = pts[np.linspace(0, len(pts)-1, max_pts).astype(int)]
+    return pts
+
+# num_of_nodes points along the spline tck, equally spaced in arc length.
+# the cumulative arc length is computed once, on a parameter grid that is refined until the total length converges
+def resample_spline (tck, num_of_nodes, tol=1e-4, max_samples=2**14):
+    u_fine = np.linspace(0, 1, 65)
+    spline_pts = np.array(interpolate.splev(u_fine, tck)).T
+    seg_len = np.sqrt(np.sum(np.square(np.diff(spline_pts, axis=0)), axis=1))
+    while len(u_fine) < max_samples:
+        u_finer = np.linspace(0, 1, 2*len(u_fine)-1)
+        spline_pts = np.array(interpolate.splev(u_finer, tck)).T
+        finer_seg_len = np.sqrt(np.sum(np.square(np.diff(spline_pts, axis=0)), axis=1))
+        converged = np.sum(finer_seg_len) - np.sum(seg_len) <= tol * np.sum(finer_seg_len)
+        u_fine, seg_len = u_finer, finer_seg_len
+        if converged:
+            break
+
+    arc_len = np.concatenate(([0], np.cumsum(seg_len)))
+    u_nodes = np.interp(np.linspace(0, arc_len[-1], num_of_nodes), arc_len, u_fine)
+    return np.array(interpolate.splev(u_nodes, tck)).T
+
+# cur_image: rgb image (H*W*3, RGB order)
+# cur_depth: depth image aligned with cur_image (H*W, in mm)
+# camera: CameraModel of the rgb camera
+# lower, upper: hsv thresholds, only used when multi_color_dlo is False
+# multi_scale: extract chains on a downsampled mask (see refine_chains in utils.py)
+# num_candidates: None for the dense chain merging assignment, otherwise the number of nearest tips each tip is matched
+# against (see match_tips in utils.py). faster on masks that break into many chains, but the assignment can be slightly
+# worse than the dense one
+# timer: Timer that gets the durations of the segmentation, extraction, back_projection and spline_fitting stages
+# returns the num_of_nodes*3 initial node positions, or None if no dlo is found in the image
+def compute_init_nodes (cur_image, cur_depth, camera, num_of_nodes, lower, upper, multi_color_dlo=False, mask_smoothing='median', multi_scale=False, num_candidates=None, visualize_process=False, timer=None):
+
+    if timer is None:
+        timer = Timer()
+
+    with timer.span('segmentation'):
+        hsv_image = cv2.cvtColor(cur_image.copy(), cv2.COLOR_RGB2HSV)
+
+        if not multi_color_dlo:
+            # color thresholding
+            mask = cv2.inRange(hsv_image, lower, upper)
+        else:
+            # color thresholding
+            mask = color_thresholding(hsv_image, cur_depth)
+
+    with timer.span('extraction'):
+        # only process the region around the dlo. the padding keeps the smoothing filter's window inside the crop;
+        # speckles much smaller than the window do not survive smoothing and do not widen the region
+        roi = mask_bounding_box(mask, padding=20, min_area=100)
+        if roi is None:
+            return None
+        x_min, y_min, x_max, y_max = roi
+        mask = mask[y_min:y_max, x_min:x_max].copy()
+
+        # coarse to fine: extract and merge chains on a downsampled mask, then refine them at full resolution.
+        # the downsampling factor follows the dlo's pixel width so thin dlos are not broken up
+        img_scale = 1
+        seg_length = 8
+        if multi_scale:
+            pixel_width = estimate_pixel_width(mask)
+            img_scale = select_img_scale(pixel_width)
+            seg_length = max(3, int(round(seg_length / img_scale)))
+
+        # returns the pixel coord of points (in order). a list of lists
+        extracted_chains = extract_connected_skeleton(visualize_process, cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR), img_scale=img_scale, seg_length=seg_length, max_curvature=25, num_candidates=num_candidates, smoothing=mask_smoothing)
+        if len(extracted_chains) == 0:
+            return None
+        if img_scale != 1:
+            extracted_chains = refine_chains(extracted_chains, mask, img_scale, pixel_width)
+
+        all_pixel_coords = []
+        for chain in extracted_chains:
+            all_pixel_coords += chain
+
+    with timer.span('back_projection'):
+        # back to full frame pixel coordinates
+        all_pixel_coords = np.array(all_pixel_coords) + np.array([x_min, y_min])
+        all_pixel_coords = np.flip(all_pixel_coords, 1)
+
+        pixel_y = all_pixel_coords[:, 0]
+        pixel_x = all_pixel_coords[:, 1]
+        pc_z = cur_depth[pixel_y, pixel_x] / 1000.0
+        extracted_chains_3d = camera.back_project(pixel_y, pixel_x, pc_z)
+
+        # do not include those without depth values
+        extracted_chains_3d = extracted_chains_3d[((extracted_chains_3d[:, 0] != 0) | (extracted_chains_3d[:, 1] != 0) | (extracted_chains_3d[:, 2] != 0))]
+
+        if multi_color_dlo:
+            depth_threshold = 0.58  # m
+            extracted_chains_3d = extracted_chains_3d[extracted_chains_3d[:, 2] > depth_threshold]
+
+    with timer.span('spline_fitting'):
+        # the spline is fitted to a bounded number of points so fitting cost does not grow with the dlo's length.
+        # the smoothing condition is a sum over all points, scale it with the number of points that are kept
+        fit_pts = subsample_chain(extracted_chains_3d)
+        tck, u = interpolate.splprep(fit_pts.T, s=0.0005 * len(fit_pts) / len(extracted_chains_3d))
+
+        init_nodes = resample_spline(tck, num_of_nodes)
+
+    return init_nodes
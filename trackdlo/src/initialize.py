@@ -2,135 +2,59 @@
 
 import rospy
 import ros_numpy
-from sensor_msgs.msg import PointCloud2, PointField, Image, CameraInfo
-import sensor_msgs.point_cloud2 as pcl2
-import std_msgs.msg
+from sensor_msgs.msg import PointCloud2, Image, CameraInfo
 import message_filters
 
 import struct
-import time
-import cv2
-import numpy as np
-import time
 
 from visualization_msgs.msg import MarkerArray
-from scipy import interpolate
 
-from utils import extract_connected_skeleton, ndarray2MarkerArray
+from utils import ndarray2MarkerArray
+from init_pipeline import compute_init_nodes
+from camera_model import CameraModel
+from pointcloud import PointCloudSerializer
+from timing import Timer
 
-proj_matrix = None
+camera = None
 def camera_info_callback (info):
-    global proj_matrix
-    proj_matrix = np.array(list(info.P)).reshape(3, 4)
+    global camera
+    camera = CameraModel.from_camera_info(info)
     print('Received camera projection matrix:')
-    print(proj_matrix)
+    print(camera.proj_matrix)
     camera_info_sub.unregister()
 
-def color_thresholding (hsv_image, cur_depth):
-    # --- rope blue ---
-    lower = (90, 90, 60)
-    upper = (130, 255, 255)
-    mask_dlo = cv2.inRange(hsv_image, lower, upper).astype('uint8')
-
-    # --- tape red ---
-    lower = (130, 60, 40)
-    upper = (255, 255, 255)
-    mask_red_1 = cv2.inRange(hsv_image, lower, upper).astype('uint8')
-    lower = (0, 60, 40)
-    upper = (10, 255, 255)
-    mask_red_2 = cv2.inRange(hsv_image, lower, upper).astype('uint8')
-    mask_marker = cv2.bitwise_or(mask_red_1.copy(), mask_red_2.copy()).astype('uint8')
-
-    # combine masks
-    mask = cv2.bitwise_or(mask_marker.copy(), mask_dlo.copy())
-
-    # filter mask base on depth values
-    mask[cur_depth < 0.58*1000] = 0
-
-    return mask
-
 def callback (rgb, depth):
     global lower, upper
 
+    if camera is None:
+        print('Waiting for camera info...')
+        return
+
     print("Initializing...")
 
     # process rgb image
     cur_image = ros_numpy.numpify(rgb)
-    hsv_image = cv2.cvtColor(cur_image.copy(), cv2.COLOR_RGB2HSV)
 
     # process depth image
     cur_depth = ros_numpy.numpify(depth)
 
-    if not multi_color_dlo:
-        # color thresholding
-        mask = cv2.inRange(hsv_image, lower, upper)
-    else:
-        # color thresholding
-        mask = color_thresholding(hsv_image, cur_depth)
-
-    start_time = time.time()
-    mask = cv2.cvtColor(mask.copy(), cv2.COLOR_GRAY2BGR)
-
-    # returns the pixel coord of points (in order). a list of lists
-    img_scale = 1
-    extracted_chains = extract_connected_skeleton(visualize_initialization_process, mask, img_scale=img_scale, seg_length=8, max_curvature=25)
-
-    all_pixel_coords = []
-    for chain in extracted_chains:
-        all_pixel_coords += chain
-    print('Finished extracting chains. Time taken:', time.time()-start_time)
-
-    all_pixel_coords = np.array(all_pixel_coords) * img_scale
-    all_pixel_coords = np.flip(all_pixel_coords, 1)
-
-    pc_z = cur_depth[tuple(map(tuple, all_pixel_coords.T))] / 1000.0
-    f = proj_matrix[0, 0]
-    cx = proj_matrix[0, 2]
-    cy = proj_matrix[1, 2]
-    pixel_x = all_pixel_coords[:, 1]
-    pixel_y = all_pixel_coords[:, 0]
-
-    pc_x = (pixel_x - cx) * pc_z / f
-    pc_y = (pixel_y - cy) * pc_z / f
-    extracted_chains_3d = np.vstack((pc_x, pc_y))
-    extracted_chains_3d = np.vstack((extracted_chains_3d, pc_z))
-    extracted_chains_3d = extracted_chains_3d.T
-
-    # do not include those without depth values
-    extracted_chains_3d = extracted_chains_3d[((extracted_chains_3d[:, 0] != 0) | (extracted_chains_3d[:, 1] != 0) | (extracted_chains_3d[:, 2] != 0))]
-
-    if multi_color_dlo:
-        depth_threshold = 0.58  # m
-        extracted_chains_3d = extracted_chains_3d[extracted_chains_3d[:, 2] > depth_threshold]
-
-    # tck, u = interpolate.splprep(extracted_chains_3d.T, s=0.001)
-    tck, u = interpolate.splprep(extracted_chains_3d.T, s=0.0005)
-    # 1st fit, less points
-    u_fine = np.linspace(0, 1, 300) # <-- num fit points
-    x_fine, y_fine, z_fine = interpolate.splev(u_fine, tck)
-    spline_pts = np.vstack((x_fine, y_fine, z_fine)).T
-
-    # 2nd fit, higher accuracy
-    num_true_pts = int(np.sum(np.sqrt(np.sum(np.square(np.diff(spline_pts, axis=0)), axis=1))) * 1000)
-    u_fine = np.linspace(0, 1, num_true_pts) # <-- num true points
-    x_fine, y_fine, z_fine = interpolate.splev(u_fine, tck)
-    spline_pts = np.vstack((x_fine, y_fine, z_fine)).T
-    total_spline_len = np.sum(np.sqrt(np.sum(np.square(np.diff(spline_pts, axis=0)), axis=1)))
-
-    init_nodes = spline_pts[np.linspace(0, num_true_pts-1, num_of_nodes).astype(int)]
-
-    results = ndarray2MarkerArray(init_nodes, result_frame_id, [1, 150/255, 0, 0.75], [0, 1, 0, 0.75])
-    results_pub.publish(results)
-
-    # add color
-    pc_rgba = struct.unpack('I', struct.pack('BBBB', 255, 40, 40, 255))[0]
-    pc_rgba_arr = np.full((len(init_nodes), 1), pc_rgba)
-    pc_colored = np.hstack((init_nodes, pc_rgba_arr)).astype(object)
-    pc_colored[:, 3] = pc_colored[:, 3].astype(int)
-
-    header.stamp = rospy.Time.now()
-    converted_points = pcl2.create_cloud(header, fields, pc_colored)
-    pc_pub.publish(converted_points)
+    timer = Timer()
+    init_nodes = compute_init_nodes(cur_image, cur_depth, camera, num_of_nodes, lower, upper, multi_color_dlo, mask_smoothing, multi_scale_initialization, num_tip_candidates, visualize_initialization_process, timer)
+    if init_nodes is None:
+        print('No dlo found in the segmentation mask, waiting for the next frame.')
+        return
+
+    with timer.span('publishing'):
+        results = ndarray2MarkerArray(init_nodes, result_frame_id, [1, 150/255, 0, 0.75], [0, 1, 0, 0.75])
+        results_pub.publish(results)
+
+        # add color
+        pc_rgba = struct.unpack('I', struct.pack('BBBB', 255, 40, 40, 255))[0]
+        converted_points = pc_serializer.serialize(init_nodes, pc_rgba, rospy.Time.now())
+        pc_pub.publish(converted_points)
+
+    print('Finished initial node set computation:')
+    print(timer.format_summary())
 
     rospy.signal_shutdown('Finished initial node set computation.')
 
@@ -144,6 +68,12 @@ if __name__=='__main__':
     depth_topic = rospy.get_param('/init_tracker/depth_topic')
     result_frame_id = rospy.get_param('/init_tracker/result_frame_id')
     visualize_initialization_process = rospy.get_param('/init_tracker/visualize_initialization_process')
+    mask_smoothing = rospy.get_param('/init_tracker/mask_smoothing')
+    multi_scale_initialization = rospy.get_param('/init_tracker/multi_scale_initialization')
+    # 0 uses the dense chain merging assignment
+    num_tip_candidates = rospy.get_param('/init_tracker/num_tip_candidates', 0)
+    if num_tip_candidates <= 0:
+        num_tip_candidates = None
 
     hsv_threshold_upper_limit = rospy.get_param('/init_tracker/hsv_threshold_upper_limit')
     hsv_threshold_lower_limit = rospy.get_param('/init_tracker/hsv_threshold_lower_limit')
@@ -157,14 +87,7 @@ if __name__=='__main__':
     rgb_sub = message_filters.Subscriber(rgb_topic, Image)
     depth_sub = message_filters.Subscriber(depth_topic, Image)
 
-    # header
-    header = std_msgs.msg.Header()
-    header.stamp = rospy.Time.now()
-    header.frame_id = result_frame_id
-    fields = [PointField('x', 0, PointField.FLOAT32, 1),
-                PointField('y', 4, PointField.FLOAT32, 1),
-                PointField('z', 8, PointField.FLOAT32, 1),
-                PointField('rgba', 12, PointField.UINT32, 1)]
+    pc_serializer = PointCloudSerializer(result_frame_id)
     pc_pub = rospy.Publisher ('/trackdlo/init_nodes', PointCloud2, queue_size=10)
     results_pub = rospy.Publisher ('/trackdlo/init_nodes_markers', MarkerArray, queue_size=10)
 
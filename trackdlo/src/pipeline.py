@@ -0,0 +1,57 @@
+import collections
+import threading
+import traceback
+
+# building blocks for running the stages of a tracking node in separate threads. no ROS dependency.
+# stages are connected by bounded queues that drop the oldest frame when full, so a slow stage always works on the most
+# recent frame and latency does not build up behind it
+
+class LatestQueue:
+    def __init__ (self, maxsize=1):
+        self.items = collections.deque(maxlen=maxsize)
+        self.cond = threading.Condition()
+        self.num_dropped = 0
+
+    # never blocks, drops the oldest item when the queue is full
+    def put (self, item):
+        with self.cond:
+            if len(self.items) == self.items.maxlen:
+                self.num_dropped += 1
+            self.items.append(item)
+            self.cond.notify()
+
+    # returns None if nothing arrived within timeout (s)
+    def get (self, timeout=None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: len(self.items) > 0, timeout):
+                return None
+            return self.items.popleft()
+
+# runs func on every item of in_queue and puts the results (if not None) into out_queue
+class StageThread (threading.Thread):
+    def __init__ (self, name, func, in_queue, out_queue=None):
+        super().__init__(name=name, daemon=True)
+        self.func = func
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.stop_event = threading.Event()
+
+    def run (self):
+        while not self.stop_event.is_set():
+            item = self.in_queue.get(timeout=0.1)
+            if item is None:
+                continue
+
+            # a failing frame should not take the stage down
+            try:
+                result = self.func(item)
+            except Exception:
+                print('Stage', self.name, 'failed on a frame:')
+                traceback.print_exc()
+                continue
+
+            if result is not None and self.out_queue is not None:
+                self.out_queue.put(result)
+
+    def stop (self):
+        self.stop_event.set()
@@ -0,0 +1,121 @@
+import numpy as np
+
+# point cloud helpers shared by the python nodes. no ROS dependency
+
+# gathers the points of an organized point cloud (one point per image pixel, row major like the image) that lie under a
+# single channel mask. only the masked points are read, and the output buffer is reused between frames
+class MaskedPointExtractor:
+    # min_depth, max_depth: depth gate (m) applied in the same gather. points without depth have z = 0 and are always
+    # dropped
+    def __init__ (self, min_depth=0.0, max_depth=None, dtype=np.float64):
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.dtype = dtype
+        self.buffer = np.empty((0, 3), dtype=dtype)
+
+    # cloud: structured array with x, y, z fields (e.g. from ros_numpy's pointcloud2_to_array) or an array of xyz
+    # points, with as many points as the mask has pixels
+    # mask: H*W, nonzero where points should be kept
+    # returns an N*3 view into the reused buffer, only valid until the next call
+    def extract (self, cloud, mask):
+        num_cloud_pts = cloud.size if cloud.dtype.names else cloud.size // 3
+        if num_cloud_pts != mask.size:
+            raise ValueError('Point cloud size does not match the mask: {} points for {} pixels'.format(num_cloud_pts, mask.size))
+
+        if cloud.dtype.names:
+            cloud = cloud.reshape(-1)
+            xs, ys, zs = cloud['x'], cloud['y'], cloud['z']
+        else:
+            cloud = cloud.reshape(-1, 3)
+            xs, ys, zs = cloud[:, 0], cloud[:, 1], cloud[:, 2]
+
+        idx = np.flatnonzero(mask)
+        z = zs[idx]
+        # nan depths fail both comparisons
+        valid = z > self.min_depth
+        if self.max_depth is not None:
+            valid &= z < self.max_depth
+        idx = idx[valid]
+
+        num_pts = len(idx)
+        if num_pts > len(self.buffer):
+            self.buffer = np.empty((max(num_pts, 2*len(self.buffer)), 3), dtype=self.dtype)
+        points = self.buffer[:num_pts]
+        points[:, 0] = xs[idx]
+        points[:, 1] = ys[idx]
+        points[:, 2] = z[valid]
+
+        return points
+
+# voxel grid downsampling: every occupied voxel is replaced by the mean of its points, like open3d's voxel_down_sample
+# (same voxel grid, anchored half a voxel below the minimum bound). the voxel coordinates are hashed into one int64 key,
+# the points are sorted by key and the means are segment sums over the sorted points. the output is ordered by voxel
+# points: N*3, float64 or float32 (the sums are accumulated in float64 either way)
+# backend: 'numpy', or 'open3d' to use open3d (imported on first use)
+def voxel_downsample (points, voxel_size, backend='numpy'):
+    if backend == 'open3d':
+        import open3d as o3d
+        pcd = o3d.geometry.PointCloud()
+        pcd.points = o3d.utility.Vector3dVector(points.astype(np.float64, copy=False))
+        return np.asarray(pcd.voxel_down_sample(voxel_size=voxel_size).points).astype(points.dtype, copy=False)
+    elif backend != 'numpy':
+        raise ValueError('Unknown voxel downsampling backend: {}'.format(backend))
+
+    if len(points) == 0:
+        return points[:0].copy()
+
+    min_bound = np.min(points, axis=0).astype(np.float64) - voxel_size * 0.5
+    coords = np.floor((points - min_bound) / voxel_size).astype(np.int64)
+    dims = np.max(coords, axis=0) + 1
+    keys = (coords[:, 0] * dims[1] + coords[:, 1]) * dims[2] + coords[:, 2]
+
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+    sums = np.add.reduceat(points[order], starts, axis=0, dtype=np.float64)
+    counts = np.diff(np.append(starts, len(points)))
+
+    return (sums / counts[:, None]).astype(points.dtype, copy=False)
+
+# writes points as x, y, z (float32) and rgba (uint32) into a PointCloud2 message. the points are packed into a reused
+# structured array whose bytes become the message data, so serializing is a copy instead of a python loop over points.
+# the message object is reused as well
+class PointCloudSerializer:
+    dtype = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('rgba', '<u4')])
+
+    def __init__ (self, frame_id):
+        # imported here so the rest of this module can be used without ROS
+        from sensor_msgs.msg import PointCloud2, PointField
+
+        self.msg = PointCloud2()
+        self.msg.header.frame_id = frame_id
+        self.msg.height = 1
+        self.msg.fields = [PointField('x', 0, PointField.FLOAT32, 1),
+                           PointField('y', 4, PointField.FLOAT32, 1),
+                           PointField('z', 8, PointField.FLOAT32, 1),
+                           PointField('rgba', 12, PointField.UINT32, 1)]
+        self.msg.is_bigendian = False
+        self.msg.point_step = self.dtype.itemsize
+        self.msg.is_dense = True
+        self.buffer = np.empty(0, dtype=self.dtype)
+
+    # points: N*3
+    # rgba: packed color, one for all points or one per point
+    # stamp: header stamp, left unchanged if None
+    def serialize (self, points, rgba, stamp=None):
+        num_pts = len(points)
+        if num_pts > len(self.buffer):
+            self.buffer = np.empty(max(num_pts, 2*len(self.buffer)), dtype=self.dtype)
+        cloud = self.buffer[:num_pts]
+        cloud['x'] = points[:, 0]
+        cloud['y'] = points[:, 1]
+        cloud['z'] = points[:, 2]
+        cloud['rgba'] = rgba
+
+        if stamp is not None:
+            self.msg.header.stamp = stamp
+        self.msg.width = num_pts
+        self.msg.row_step = num_pts * self.dtype.itemsize
+        self.msg.data = cloud.tobytes()
+
+        return self.msg
@@ -0,0 +1,422 @@
+import os
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy import sparse
+from scipy.sparse.csgraph import minimum_spanning_tree, shortest_path
+from scipy.spatial import cKDTree
+
+from utils import pt2pt_dis_sq
+
+# cpd based node registration (register) and tracking (cpd_lle), without any ROS dependency.
+# used by utils/tracking_test.py
+
+# ----- E step -----
+# the M*N squared distances are computed as |x|^2 + |y|^2 - 2 y.x, in chunks of chunk_size points, so only M*chunk_size
+# temporaries are alive per chunk instead of the M*N*D difference tensor. numpy releases the GIL in matmul and exp,
+# the chunks are spread over a thread pool
+
+thread_pools = {}
+def get_thread_pool (num_threads=None):
+    if num_threads is None:
+        num_threads = os.cpu_count()
+    if num_threads not in thread_pools:
+        thread_pools[num_threads] = ThreadPoolExecutor(num_threads)
+    return thread_pools[num_threads]
+
+# squared distances between the rows of Y (M*D) and the rows of X (N*D), M*N
+# X_sq, Y_sq: squared norms of the rows, if already known
+def sq_distances (X, Y, X_sq=None, Y_sq=None):
+    if X_sq is None:
+        X_sq = np.sum(np.square(X), axis=1)
+    if Y_sq is None:
+        Y_sq = np.sum(np.square(Y), axis=1)
+    dis_sq = np.matmul(Y, X.T)
+    dis_sq *= -2
+    dis_sq += Y_sq[:, None]
+    dis_sq += X_sq[None, :]
+    # the identity can go slightly negative through cancellation
+    np.maximum(dis_sq, 0, out=dis_sq)
+    return dis_sq
+
+# sum of the squared distances over all (y, x) pairs, without forming any pairwise quantity
+def sum_sq_distances (X, Y):
+    return len(Y) * np.sum(np.square(X)) + len(X) * np.sum(np.square(Y)) - 2 * np.dot(np.sum(X, axis=0), np.sum(Y, axis=0))
+
+# posterior probability matrix P (M*N) of the gaussian mixture centered at Y, with variance sigma2 and outlier weight mu
+# chunk_size: number of points processed at once
+# num_threads: size of the thread pool, defaults to the number of cpus
+def compute_P (X, Y, sigma2, mu, chunk_size=2048, num_threads=None):
+    M, D = Y.shape
+    N = len(X)
+
+    c = (2 * np.pi * sigma2) ** (D / 2)
+    c = c * mu / (1 - mu)
+    c = c * M / N
+
+    X_sq = np.sum(np.square(X), axis=1)
+    Y_sq = np.sum(np.square(Y), axis=1)
+    P = np.empty((M, N))
+
+    def fill_chunk (start):
+        end = min(start + chunk_size, N)
+        P_chunk = sq_distances(X[start:end], Y, X_sq[start:end], Y_sq)
+        P_chunk *= -1 / (2 * sigma2)
+        np.exp(P_chunk, out=P_chunk)
+        den = np.sum(P_chunk, axis=0)
+        den[den == 0] = np.finfo(float).eps
+        den += c
+        P_chunk /= den
+        P[:, start:end] = P_chunk
+
+    chunk_starts = range(0, N, chunk_size)
+    if len(chunk_starts) == 1 or num_threads == 1:
+        for start in chunk_starts:
+            fill_chunk(start)
+    else:
+        # list() waits for all chunks and re-raises exceptions from the workers
+        list(get_thread_pool(num_threads).map(fill_chunk, chunk_starts))
+
+    return P
+
+def register(pts, M, mu=0, max_iter=50, chunk_size=2048, num_threads=None):
+
+    # initial guess
+    X = pts.copy()
+    Y = np.vstack((np.arange(0, 0.1, (0.1/M)), np.zeros(M), np.zeros(M))).T
+    if len(pts[0]) == 2:
+        Y = np.vstack((np.arange(0, 0.1, (0.1/M)), np.zeros(M))).T
+    s = 1
+    D = len(pts[0])
+    X_sq = np.sum(np.square(X), axis=1)
+
+    def get_estimates (Y, s):
+
+        # construct the P matrix
+        P = compute_P(X, Y, s, mu, chunk_size, num_threads)  # P is M*N
+        Pt1 = np.sum(P, axis=0)  # equivalent to summing from 0 to M (results in N terms)
+        P1 = np.sum(P, axis=1)  # equivalent to summing from 0 to N (results in M terms)
+        Np = np.sum(P1)
+        PX = np.matmul(P, X)
+
+        # get new Y
+        P1_expanded = np.full((D, M), P1).T
+        new_Y = PX / P1_expanded
+
+        # get new sigma2
+        # sum_mn P_mn |x_n - y_m|^2 = sum_n Pt1_n |x_n|^2 - 2 sum_m y_m.PX_m + sum_m P1_m |y_m|^2
+        new_s = (np.dot(Pt1, X_sq) - 2 * np.sum(Y * PX) + np.dot(P1, np.sum(np.square(Y), axis=1))) / (Np*D)
+
+        return new_Y, new_s
+
+    prev_Y, prev_s = Y, s
+    new_Y, new_s = get_estimates(prev_Y, prev_s)
+    
+    for it in range (max_iter):
+        prev_Y, prev_s = new_Y, new_s
+        new_Y, new_s = get_estimates(prev_Y, prev_s)
+
+    return new_Y, new_s
+
+# orders the nodes along the dlo.
+# the nodes are ordered along the diameter (longest path) of their minimum spanning tree. nodes on side branches of the
+# tree are placed after the node where their branch leaves the diameter path, by distance from the path
+def sort_pts (Y_0):
+    dis = np.sqrt(sq_distances(Y_0, Y_0))
+    # zero entries are missing edges for csgraph. a constant offset keeps coincident nodes connected and does not change
+    # which tree is the minimum one
+    dis += 1e-9
+    np.fill_diagonal(dis, 0)
+    mst = minimum_spanning_tree(dis)
+
+    # the farthest node (along the tree) from any node is one end of the diameter, the farthest node from that end is
+    # the other one
+    end_a = np.argmax(shortest_path(mst, directed=False, indices=0))
+    dis_a = shortest_path(mst, directed=False, indices=end_a)
+    end_b = np.argmax(dis_a)
+    dis_b = shortest_path(mst, directed=False, indices=end_b)
+    length = dis_a[end_b]
+
+    # for every node, the position along the diameter path where its branch leaves the path and its distance from it
+    path_pos = (dis_a - dis_b + length) / 2
+    path_offset = (dis_a + dis_b - length) / 2
+
+    return Y_0[np.lexsort((path_offset, path_pos))]
+
+# assuming the nodes are sorted
+# k -- going left for k indices, going right for k indices. a total of 2k neighbors.
+# near the ends, more neighbors are taken from the other side
+# returns the M*2k table of neighbor indices of every node (M >= 2k+1)
+def get_nearest_indices (k, M):
+    idx = np.arange(0, M)
+    start = np.clip(idx - k, 0, max(M - 1 - 2*k, 0))
+    window = start[:, None] + np.arange(0, 2*k+1)[None, :]
+    return window[window != idx[:, None]].reshape(M, 2*k)
+
+# reconstruction weights of every node from its k nearest nodes along the dlo (locally linear embedding)
+# the M local gram matrices are solved at once. they are rank deficient (k > 3), epsilon regularizes them
+def calc_LLE_weights (k, X, epsilon=0.00001):
+    M = len(X)
+    indices = get_nearest_indices(int(k/2), M)
+
+    # component[i] = xi - Xi, M*k*D
+    component = X[:, None, :] - X[indices]
+    Gi = np.matmul(component, np.swapaxes(component, 1, 2))
+    Gi[:, np.arange(0, indices.shape[1]), np.arange(0, indices.shape[1])] += epsilon
+
+    # wi = Gi^-1 1 / (1^T Gi^-1 1)
+    wi = np.linalg.solve(Gi, np.ones((M, indices.shape[1], 1)))[:, :, 0]
+    wi /= np.sum(wi, axis=1)[:, None]
+
+    W = np.zeros((M, M))
+    W[np.arange(0, M)[:, None], indices] = wi
+
+    return W
+
+# sparse version of compute_P: only (node, point) pairs closer than truncate standard deviations are kept, the rest of
+# the gaussian weights are close to zero. the pairs come from a kd-tree over the nodes, so the cost scales with the
+# number of points near the nodes instead of M*N
+# X_tree: cKDTree of X, which stays the same over the EM iterations
+# returns P as an M*N scipy.sparse.csr_matrix
+def compute_P_sparse (X, Y, sigma2, mu, truncate=4.0, X_tree=None):
+    M, D = Y.shape
+    N = len(X)
+
+    c = (2 * np.pi * sigma2) ** (D / 2)
+    c = c * mu / (1 - mu)
+    c = c * M / N
+
+    if X_tree is None:
+        X_tree = cKDTree(X)
+    Y_tree = cKDTree(Y)
+    pairs = Y_tree.sparse_distance_matrix(X_tree, truncate * np.sqrt(sigma2), output_type='ndarray')
+    node_idx, pt_idx, dis = pairs['i'], pairs['j'], pairs['v']
+
+    # points with no node within the radius still belong to their nearest node, as they would in the dense P
+    far_pts = np.flatnonzero(np.bincount(pt_idx, minlength=N) == 0)
+    if len(far_pts) > 0:
+        far_dis, far_nodes = Y_tree.query(X[far_pts])
+        node_idx = np.concatenate((node_idx, far_nodes))
+        pt_idx = np.concatenate((pt_idx, far_pts))
+        dis = np.concatenate((dis, far_dis))
+
+    p = np.exp(-np.square(dis) / (2 * sigma2))
+    den = np.bincount(pt_idx, weights=p, minlength=N)
+    den[den == 0] = np.finfo(float).eps
+    den += c
+    p /= den[pt_idx]
+
+    return sparse.csr_matrix((p, (node_idx, pt_idx)), shape=(M, N))
+
+# per tracker cache of what cpd_lle derives from the previous node set Y_0: the kernel G, the geodesic distances
+# between nodes, the LLE weights L, H = (I-L)^T (I-L) and H G. they only depend on M, beta, k, the kernel type and Y_0,
+# and are recomputed when one of the parameters changes or when a node has moved more than node_tol (m) since they were
+# computed. node_tol=0 recomputes them whenever Y_0 changes and is exact. with node_tol > 0, G, L and H can be computed
+# from nodes up to node_tol away from the current Y_0 (HY_0 is always recomputed), which approximates the exact step.
+# the M step system itself changes with P1 and sigma2 on every iteration, so it is still solved from scratch
+class CpdLleState:
+    def __init__ (self, k=6, node_tol=0.0):
+        self.k = k
+        self.node_tol = node_tol
+        self.num_updates = 0
+        self.invalidate()
+
+    def invalidate (self):
+        self.key = None
+        self.ref_nodes = None
+
+    def is_valid (self, Y_0, key):
+        if self.key != key:
+            return False
+        return np.max(np.sum(np.square(Y_0 - self.ref_nodes), axis=1)) <= self.node_tol**2
+
+    def update (self, Y_0, beta, use_geodesic):
+        key = (len(Y_0), beta, self.k, use_geodesic)
+        if self.is_valid(Y_0, key):
+            return
+
+        M = len(Y_0)
+        if not use_geodesic:
+            self.converted_node_dis = None
+            # Gaussian Kernel
+            self.G = np.exp(-sq_distances(Y_0, Y_0) / (2 * beta**2))
+        else:
+            # compute the geodesic distances between nodes
+            seg_dis = np.sqrt(np.sum(np.square(np.diff(Y_0, axis=0)), axis=1))
+            converted_node_coord = np.concatenate(([0], np.cumsum(seg_dis)))
+            self.converted_node_dis = np.abs(converted_node_coord[None, :] - converted_node_coord[:, None])
+
+            # Gaussian Kernel
+            self.G = np.exp(-np.square(self.converted_node_dis) / (2 * beta**2))
+
+            # temp
+            # G[converted_node_dis > 0.07] = 0
+
+        # get the LLE matrix
+        self.L = calc_LLE_weights(self.k, Y_0)
+        self.H = np.matmul((np.identity(M) - self.L).T, np.identity(M) - self.L)
+        self.HG = np.matmul(self.H, self.G)
+
+        self.key = key
+        self.ref_nodes = Y_0.copy()
+        self.num_updates += 1
+
+def cpd_lle (X, Y_0, beta, alpha, gamma, mu, max_iter=50, tol=0.00001, include_lle=True, use_geodesic=False, use_prev_sigma2=False, sigma2_0=None, chunk_size=2048, num_threads=None, state=None, deadline_ms=None, return_info=False, truncate=None):
+
+    start_time = time.time()
+
+    # define params
+    M = len(Y_0)
+    N = len(X)
+    D = len(X[0])
+
+    # initialization
+    # G, the LLE matrices and the geodesic node distances, reused from the previous frame when still valid
+    if state is None:
+        state = CpdLleState()
+    state.update(Y_0, beta, use_geodesic)
+    G = state.G
+    H = state.H
+    HG = state.HG
+    converted_node_dis = state.converted_node_dis
+
+    Y = Y_0.copy()
+
+    # initialize sigma2
+    if not use_prev_sigma2:
+        sigma2 = sum_sq_distances(X, Y) / (D * M * N)
+    else:
+        sigma2 = sigma2_0
+
+    # constant over the iterations
+    HY_0 = np.matmul(H, Y_0)
+    X_sq = np.sum(np.square(X), axis=1)
+
+    # truncated sparse E step, not used with geodesic distances (they need all of P)
+    use_sparse = truncate is not None and not use_geodesic
+    if use_sparse:
+        X_tree = cKDTree(X)
+
+    # loop until convergence, max_iter or the deadline is reached
+    # with a deadline, no iteration is started that is expected to end after it (based on the slowest iteration so far).
+    # the first iteration always runs
+    iterations = 0
+    residual = np.inf
+    deadline_hit = False
+    max_iter_time = 0
+    e_step_time = 0
+    m_step_time = 0
+    for it in range (0, max_iter):
+
+        if deadline_ms is not None and it > 0 and (time.time() - start_time + max_iter_time) * 1000 > deadline_ms:
+            deadline_hit = True
+            print("deadline reached after", it, "iterations")
+            break
+        iter_start_time = time.time()
+
+        # ----- E step: compute posteriori probability matrix P -----
+        if use_sparse:
+            P = compute_P_sparse(X, Y, sigma2, mu, truncate, X_tree)
+        else:
+            P = compute_P(X, Y, sigma2, mu, chunk_size, num_threads)
+
+        # if use geodesic, overwrite P
+        # this section looks long, but it is simply replacing the Euclidean distances in P with geodesic distances
+        if use_geodesic:
+            max_p_nodes = np.argmax(P, axis=0)
+
+            # the second node is the more likely of the max node's two neighbors along the dlo
+            potential_2nd_max_p_nodes_1 = max_p_nodes - 1
+            potential_2nd_max_p_nodes_2 = max_p_nodes + 1
+            potential_2nd_max_p_nodes_1 = np.where(potential_2nd_max_p_nodes_1 < 0, 1, potential_2nd_max_p_nodes_1)
+            potential_2nd_max_p_nodes_2 = np.where(potential_2nd_max_p_nodes_2 > M-1, M-2, potential_2nd_max_p_nodes_2)
+            potential_2nd_max_p_1 = P[potential_2nd_max_p_nodes_1, np.arange(0, N)]
+            potential_2nd_max_p_2 = P[potential_2nd_max_p_nodes_2, np.arange(0, N)]
+            next_max_p_nodes = np.where(potential_2nd_max_p_1 > potential_2nd_max_p_2, potential_2nd_max_p_nodes_1, potential_2nd_max_p_nodes_2)
+            dis_to_max_p_nodes = np.sqrt(np.sum(np.square(Y[max_p_nodes]-X), axis=1))
+            dis_to_2nd_largest_p_nodes = np.sqrt(np.sum(np.square(Y[next_max_p_nodes]-X), axis=1))
+
+            # the two nodes are adjacent. nodes up to the lower one are reached through the lower one,
+            # nodes from the upper one on through the upper one
+            lower_nodes = np.minimum(max_p_nodes, next_max_p_nodes)
+            upper_nodes = np.maximum(max_p_nodes, next_max_p_nodes)
+            max_node_smaller = max_p_nodes < next_max_p_nodes
+            dis_to_lower_nodes = np.where(max_node_smaller, dis_to_max_p_nodes, dis_to_2nd_largest_p_nodes)
+            dis_to_upper_nodes = np.where(max_node_smaller, dis_to_2nd_largest_p_nodes, dis_to_max_p_nodes)
+
+            # converted_node_dis is symmetric, column i is the distance from node i to every node
+            converted_P = np.where(np.arange(0, M)[:, None] <= lower_nodes[None, :],
+                                   converted_node_dis[:, lower_nodes] + dis_to_lower_nodes,
+                                   converted_node_dis[:, upper_nodes] + dis_to_upper_nodes)
+
+            # converted_P is M*N and no longer needed, compute P in place
+            P = np.square(converted_P, out=converted_P)
+            P *= -1 / (2 * sigma2)
+            np.exp(P, out=P)
+            den = np.sum(P, axis=0)
+            den[den == 0] = np.finfo(float).eps
+            c = (2 * np.pi * sigma2) ** (D / 2)
+            c = c * mu / (1 - mu)
+            c = c * M / N
+            den += c
+            P /= den
+
+        # works for both dense and sparse P
+        Pt1 = np.asarray(P.sum(axis=0)).ravel()
+        P1 = np.asarray(P.sum(axis=1)).ravel()
+        Np = np.sum(P1)
+        PX = P.dot(X)
+
+        # print(Pt1)
+    
+        m_step_start_time = time.time()
+        e_step_time += m_step_start_time - iter_start_time
+
+        # ----- M step: solve for new weights and variance -----
+        # diag(P1) @ G is a row scaling of G
+        A_matrix = P1[:, None] * G
+        A_matrix[np.diag_indices(M)] += alpha * sigma2
+        B_matrix = PX - P1[:, None] * Y_0
+        if include_lle:
+            A_matrix += sigma2 * gamma * HG
+            B_matrix -= sigma2 * gamma * HY_0
+
+        # solve for W
+        W = np.linalg.solve(A_matrix, B_matrix)
+
+        # the traces of X^T diag(Pt1) X, PX^T T and T^T diag(P1) T, without forming the diagonal matrices
+        T = Y_0 + np.matmul(G, W)
+        trXtdPt1X = np.dot(Pt1, X_sq)
+        trPXtT = np.sum(PX * T)
+        trTtdP1T = np.dot(P1, np.sum(np.square(T), axis=1))
+
+        # solve for sigma^2
+        sigma2 = (trXtdPt1X - 2*trPXtT + trTtdP1T) / (Np * D)
+
+        iterations += 1
+        m_step_time += time.time() - m_step_start_time
+        max_iter_time = max(max_iter_time, time.time() - iter_start_time)
+
+        # update Y
+        residual = pt2pt_dis_sq(Y, T)
+        if residual < tol:
+            # if converged, break loop
+            Y = T
+            print("iteration until convergence:", it)
+            break
+        else:
+            # keep going until max iteration is reached
+            Y = T
+
+            if it == max_iter - 1:
+                print("did not converge!")
+
+    if return_info:
+        # residual: squared change of the nodes in the last iteration
+        # e_step_time, m_step_time: time (s) spent in each step, summed over the iterations
+        info = {'iterations': iterations, 'residual': float(residual), 'converged': bool(residual < tol), 'deadline_hit': deadline_hit,
+                'e_step_time': e_step_time, 'm_step_time': m_step_time}
+        return Y, sigma2, info
+
+    return Y, sigma2
+
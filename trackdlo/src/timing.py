@@ -0,0 +1,91 @@
+import csv
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+# per stage timing for the python nodes. no ROS dependency.
+#
+#   timer = Timer()
+#   record = {}                                  # optional, one per frame
+#   with timer.span('segmentation', record):
+#       ...
+#   timer.add('e_step', seconds, record)         # for durations measured elsewhere
+#   timer.add_record(record)                     # frame done, kept for dump()
+#
+# every stage keeps a rolling window of its latest durations for the percentiles in summary(). records hold the
+# durations of one frame and are only kept when keep_records is set. durations are reported in ms.
+# can be shared by several threads
+class Timer:
+    def __init__ (self, window=1000, keep_records=False):
+        self.window = window
+        self.keep_records = keep_records
+        self.durations = {}
+        self.counts = {}
+        self.records = []
+        self.num_records = 0
+        self.lock = threading.Lock()
+
+    def add (self, name, seconds, record=None):
+        with self.lock:
+            if name not in self.durations:
+                self.durations[name] = deque(maxlen=self.window)
+                self.counts[name] = 0
+            self.durations[name].append(seconds * 1000)
+            self.counts[name] += 1
+        if record is not None:
+            record[name] = record.get(name, 0) + seconds * 1000
+
+    @contextmanager
+    def span (self, name, record=None):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start_time, record)
+
+    # a finished frame record. numbers the frames in the order they finish
+    def add_record (self, record):
+        with self.lock:
+            record['frame'] = self.num_records
+            self.num_records += 1
+            if self.keep_records:
+                self.records.append(record)
+
+    # {stage: {count, mean, p50, p95, p99}}, over the rolling window (count is the total)
+    def summary (self):
+        with self.lock:
+            durations = {name: np.array(values) for name, values in self.durations.items()}
+            counts = dict(self.counts)
+
+        summary = {}
+        for name, values in durations.items():
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            summary[name] = {'count': counts[name], 'mean': float(np.mean(values)), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+        return summary
+
+    def format_summary (self):
+        lines = ['{:>20} {:>8} {:>10} {:>10} {:>10} {:>10}'.format('stage (ms)', 'count', 'mean', 'p50', 'p95', 'p99')]
+        for name, stats in self.summary().items():
+            lines.append('{:>20} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}'.format(name, stats['count'], stats['mean'], stats['p50'], stats['p95'], stats['p99']))
+        return '\n'.join(lines)
+
+    # writes the kept frame records to a .csv (one row per frame, one column per stage) or .json file
+    def dump (self, path):
+        with self.lock:
+            records = list(self.records)
+
+        if path.endswith('.json'):
+            with open(path, 'w') as f:
+                json.dump({'summary': self.summary(), 'frames': records}, f, indent=2)
+        elif path.endswith('.csv'):
+            names = ['frame'] + sorted(set(name for record in records for name in record) - {'frame'})
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=names)
+                writer.writeheader()
+                writer.writerows(records)
+        else:
+            raise ValueError('Unknown timing record format (expected .csv or .json): {}'.format(path))
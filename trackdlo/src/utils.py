@@ -1,13 +1,10 @@
 from skimage.morphology import skeletonize
 from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
 import cv2
 import numpy as np
 from PIL import Image, ImageFilter
 
-from visualization_msgs.msg import Marker
-from visualization_msgs.msg import MarkerArray
-from scipy.spatial.transform import Rotation as R
-
 def pt2pt_dis_sq(pt1, pt2):
     return np.sum(np.square(pt1 - pt2))
 
@@ -15,44 +12,25 @@ def pt2pt_dis(pt1, pt2):
     return np.sqrt(np.sum(np.square(pt1 - pt2)))
 
 # from geeksforgeeks: https://www.geeksforgeeks.org/check-if-two-given-line-segments-intersect/
-class Point_2D:
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
-
-# from geeksforgeeks: https://www.geeksforgeeks.org/check-if-two-given-line-segments-intersect/
+# vectorized: points are arrays whose last axis holds (x, y), all leading axes are broadcast
 # Given three collinear points p, q, r, the function checks if 
 # point q lies on line segment 'pr' 
 def onSegment(p, q, r):
-    if ( (q.x <= max(p.x, r.x)) and (q.x >= min(p.x, r.x)) and 
-           (q.y <= max(p.y, r.y)) and (q.y >= min(p.y, r.y))):
-        return True
-    return False
+    return (q[..., 0] <= np.maximum(p[..., 0], r[..., 0])) & (q[..., 0] >= np.minimum(p[..., 0], r[..., 0])) & \
+           (q[..., 1] <= np.maximum(p[..., 1], r[..., 1])) & (q[..., 1] >= np.minimum(p[..., 1], r[..., 1]))
 
 # from geeksforgeeks: https://www.geeksforgeeks.org/check-if-two-given-line-segments-intersect/
 def orientation(p, q, r):
     # to find the orientation of an ordered triplet (p,q,r)
     # function returns the following values:
-    # 0 : Collinear points
-    # 1 : Clockwise points
-    # 2 : Counterclockwise
+    #  0 : Collinear points
+    #  1 : Clockwise points
+    # -1 : Counterclockwise
       
     # See https://www.geeksforgeeks.org/orientation-3-ordered-points/amp/ 
     # for details of below formula. 
-      
-    val = (float(q.y - p.y) * (r.x - q.x)) - (float(q.x - p.x) * (r.y - q.y))
-    if (val > 0):
-          
-        # Clockwise orientation
-        return 1
-    elif (val < 0):
-          
-        # Counterclockwise orientation
-        return 2
-    else:
-          
-        # Collinear orientation
-        return 0
+    val = (q[..., 1] - p[..., 1]) * (r[..., 0] - q[..., 0]) - (q[..., 0] - p[..., 0]) * (r[..., 1] - q[..., 1])
+    return np.sign(val)
 
 # from geeksforgeeks: https://www.geeksforgeeks.org/check-if-two-given-line-segments-intersect/  
 # The main function that returns true if 
@@ -67,106 +45,304 @@ def doIntersect(p1,q1,p2,q2):
     o4 = orientation(p2, q2, q1)
   
     # General case
-    if ((o1 != o2) and (o3 != o4)):
-        return True
-  
+    intersect = (o1 != o2) & (o3 != o4)
+
     # Special Cases
-  
     # p1 , q1 and p2 are collinear and p2 lies on segment p1q1
-    if ((o1 == 0) and onSegment(p1, p2, q1)):
-        return True
-  
+    intersect |= (o1 == 0) & onSegment(p1, p2, q1)
     # p1 , q1 and q2 are collinear and q2 lies on segment p1q1
-    if ((o2 == 0) and onSegment(p1, q2, q1)):
-        return True
-  
+    intersect |= (o2 == 0) & onSegment(p1, q2, q1)
     # p2 , q2 and p1 are collinear and p1 lies on segment p2q2
-    if ((o3 == 0) and onSegment(p2, p1, q2)):
-        return True
-  
+    intersect |= (o3 == 0) & onSegment(p2, p1, q2)
     # p2 , q2 and q1 are collinear and q1 lies on segment p2q2
-    if ((o4 == 0) and onSegment(p2, q1, q2)):
-        return True
-  
-    # If none of the cases
-    return False
+    intersect |= (o4 == 0) & onSegment(p2, q1, q2)
+
+    return intersect
 
-def build_rect (pt1, pt2, width):
+# pts1, pts2: N*2 arrays holding the start and end points of N line segments
+# returns N*4*2 rectangle corners, in the order start+, start-, end-, end+
+def build_rects (pts1, pts2, width):
     # arctan2 (y, x)
-    line_angle = np.arctan2(pt2.y - pt1.y, pt2.x - pt1.x)
-    angle1 = line_angle + np.pi/2
-    angle2 = line_angle - np.pi/2
-    rect_pt1 = Point_2D(pt1.x + width/2.0*np.cos(angle1), pt1.y + width/2.0*np.sin(angle1))
-    rect_pt2 = Point_2D(pt1.x + width/2.0*np.cos(angle2), pt1.y + width/2.0*np.sin(angle2))
-    rect_pt3 = Point_2D(pt2.x + width/2.0*np.cos(angle1), pt2.y + width/2.0*np.sin(angle1))
-    rect_pt4 = Point_2D(pt2.x + width/2.0*np.cos(angle2), pt2.y + width/2.0*np.sin(angle2))
-
-    return [rect_pt1, rect_pt2, rect_pt4, rect_pt3]
-
-def check_rect_overlap (rect1, rect2):
-    overlap = False
-    for i in range (-1, 3):
-        for j in range (-1, 3):
-            if doIntersect(rect1[i], rect1[i+1], rect2[j], rect2[j+1]):
-                overlap = True
-                return overlap
+    line_angle = np.arctan2(pts2[:, 1] - pts1[:, 1], pts2[:, 0] - pts1[:, 0])
+    offset = width/2.0 * np.vstack((np.cos(line_angle + np.pi/2), np.sin(line_angle + np.pi/2))).T
+    return np.stack((pts1 + offset, pts1 - offset, pts2 - offset, pts2 + offset), axis=1)
+
+# rects1, rects2: P*4*2 arrays; checks rects1[i] against rects2[i] for all i
+# two rectangles overlap if any pair of their edges intersect
+def check_rect_overlap (rects1, rects2):
+    p1 = rects1[:, :, None, :]
+    q1 = np.roll(rects1, 1, axis=1)[:, :, None, :]
+    p2 = rects2[:, None, :, :]
+    q2 = np.roll(rects2, 1, axis=1)[:, None, :, :]
+    return np.any(doIntersect(p1, q1, p2, q2), axis=(1, 2))
+
+# enumerate the uniform grid cells touched by each box
+# returns the owning box index and the flattened cell key for every (box, cell) pair
+def grid_cells (cell_min, cell_max, num_rows):
+    nx = cell_max[:, 0] - cell_min[:, 0] + 1
+    ny = cell_max[:, 1] - cell_min[:, 1] + 1
+    counts = nx * ny
+    owner = np.repeat(np.arange(len(counts)), counts)
+    offset = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+    cell_x = cell_min[owner, 0] + offset % nx[owner]
+    cell_y = cell_min[owner, 1] + offset // nx[owner]
+    return owner, cell_x * num_rows + cell_y
+
+# test_rects: N*4*2, ref_rects: M*4*2
+# returns a length N boolean array, True where the test rectangle overlaps any reference rectangle.
+# only pairs sharing a uniform grid cell (and with overlapping bounding boxes) go through the exact test
+def find_overlapping_rects (test_rects, ref_rects):
+    overlap = np.zeros(len(test_rects), dtype=bool)
+    if len(test_rects) == 0 or len(ref_rects) == 0:
+        return overlap
+
+    test_min, test_max = np.min(test_rects, axis=1), np.max(test_rects, axis=1)
+    ref_min, ref_max = np.min(ref_rects, axis=1), np.max(ref_rects, axis=1)
+
+    # cell size follows the typical segment footprint so most boxes touch only a few cells
+    cell_size = max(np.median(np.max(ref_max - ref_min, axis=1)), 1.0)
+    origin = np.minimum(np.min(test_min, axis=0), np.min(ref_min, axis=0))
+    test_cell_min = ((test_min - origin) // cell_size).astype(int)
+    test_cell_max = ((test_max - origin) // cell_size).astype(int)
+    ref_cell_min = ((ref_min - origin) // cell_size).astype(int)
+    ref_cell_max = ((ref_max - origin) // cell_size).astype(int)
+    num_rows = max(np.max(test_cell_max[:, 1]), np.max(ref_cell_max[:, 1])) + 1
+
+    # join test and reference boxes on shared cell keys
+    test_owner, test_keys = grid_cells(test_cell_min, test_cell_max, num_rows)
+    ref_owner, ref_keys = grid_cells(ref_cell_min, ref_cell_max, num_rows)
+    order = np.argsort(ref_keys, kind='stable')
+    ref_owner, ref_keys = ref_owner[order], ref_keys[order]
+    lo = np.searchsorted(ref_keys, test_keys, side='left')
+    hi = np.searchsorted(ref_keys, test_keys, side='right')
+    counts = hi - lo
+    if np.sum(counts) == 0:
+        return overlap
+    test_idx = np.repeat(test_owner, counts)
+    ref_idx = ref_owner[np.repeat(lo, counts) + np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)]
+
+    # a pair of boxes can share more than one cell
+    pair_keys = np.unique(test_idx * len(ref_rects) + ref_idx)
+    test_idx, ref_idx = pair_keys // len(ref_rects), pair_keys % len(ref_rects)
+
+    # bounding box rejection before the exact edge intersection test
+    box_overlap = np.all((test_min[test_idx] <= ref_max[ref_idx]) & (ref_min[ref_idx] <= test_max[test_idx]), axis=1)
+    test_idx, ref_idx = test_idx[box_overlap], ref_idx[box_overlap]
+
+    hit = check_rect_overlap(test_rects[test_idx], ref_rects[ref_idx])
+    overlap[test_idx[hit]] = True
     return overlap
 
-# mode:
-#   0: start + start
-#   1: start + end
-#   2: end + start
-#   3: end + end
-def compute_cost (chain1, chain2, w_e, w_c, mode):
-    chain1 = np.array(chain1)
-    chain2 = np.array(chain2)
-
-    # start + start
-    if mode == 0:
-        # treat the second chain as needing to be reversed
-        cost_euclidean = np.linalg.norm(chain1[0] - chain2[0])
-        cost_curvature_1 = np.arccos(np.dot(chain1[0] - chain2[0], chain1[1] - chain1[0]) / (np.linalg.norm(chain1[0] - chain1[1]) * cost_euclidean))
-        cost_curvature_2 = np.arccos(np.dot(chain1[0] - chain2[0], chain2[0] - chain2[1]) / (np.linalg.norm(chain2[0] - chain2[1]) * cost_euclidean))
-        total_cost = w_e * cost_euclidean + w_c * (np.abs(cost_curvature_1) + np.abs(cost_curvature_2)) / 2.0
-    # start + end
-    elif mode == 1:
-        cost_euclidean = np.linalg.norm(chain1[0] - chain2[-1])
-        cost_curvature_1 = np.arccos(np.dot(chain1[0] - chain2[-1], chain1[1] - chain1[0]) / (np.linalg.norm(chain1[0] - chain1[1]) * cost_euclidean))
-        cost_curvature_2 = np.arccos(np.dot(chain1[0] - chain2[-1], chain2[-1] - chain2[-2]) / (np.linalg.norm(chain2[-1] - chain2[-2]) * cost_euclidean))
-        total_cost = w_e * cost_euclidean + w_c * (np.abs(cost_curvature_1) + np.abs(cost_curvature_2)) / 2.0
-    # end + start
-    elif mode == 2:
-        cost_euclidean = np.linalg.norm(chain1[-1] - chain2[0])
-        cost_curvature_1 = np.arccos(np.dot(chain2[0] - chain1[-1], chain1[-1] - chain1[-2]) / (np.linalg.norm(chain1[-1] - chain1[-2]) * cost_euclidean))
-        cost_curvature_2 = np.arccos(np.dot(chain2[0] - chain1[-1], chain2[1] - chain2[0]) / (np.linalg.norm(chain2[0] - chain2[1]) * cost_euclidean))
-        total_cost = w_e * cost_euclidean + w_c * (np.abs(cost_curvature_1) + np.abs(cost_curvature_2)) / 2.0
-    # end + end
+def chain_length (chain):
+    return np.sum(np.sqrt(np.sum(np.square(np.diff(chain, axis=0)), axis=1)))
+
+# tip positions and outward unit directions of all chains, in the cost matrix label order:
+# chain1 start, chain1 end, chain2 start, chain2 end, ...
+def extract_tips (chains):
+    tip_pos = np.array([[chain[0], chain[-1]] for chain in chains], dtype=float).reshape(-1, 2)
+    tip_dir = np.array([[np.subtract(chain[0], chain[1]), np.subtract(chain[-1], chain[-2])] for chain in chains], dtype=float).reshape(-1, 2)
+    dir_norm = np.linalg.norm(tip_dir, axis=1)
+    dir_norm[dir_norm == 0] = 1  # degenerate segment, leaves a zero direction
+    return tip_pos, tip_dir / dir_norm[:, None]
+
+# cost of connecting tip a to tip b, evaluated for all index pairs (idx_a[i], idx_b[i]) at once
+# euclidean cost: distance between the two tips
+# curvature cost: mean angle between the connecting line and the outward direction of each tip
+def compute_cost (tip_pos, tip_dir, idx_a, idx_b, w_e, w_c):
+    connection = tip_pos[idx_b] - tip_pos[idx_a]
+    cost_euclidean = np.linalg.norm(connection, axis=1)
+
+    # coincident tips have no connecting direction, treat them as a perfect continuation
+    coincident = cost_euclidean == 0
+    denom = np.where(coincident, 1, cost_euclidean)
+    cos_1 = np.where(coincident, 1, np.sum(connection * tip_dir[idx_a], axis=1) / denom)
+    cos_2 = np.where(coincident, 1, -np.sum(connection * tip_dir[idx_b], axis=1) / denom)
+    cost_curvature_1 = np.arccos(np.clip(cos_1, -1, 1))
+    cost_curvature_2 = np.arccos(np.clip(cos_2, -1, 1))
+
+    return w_e * cost_euclidean + w_c * (cost_curvature_1 + cost_curvature_2) / 2.0
+
+# dense (num of tips + 2) * (num of tips + 2) cost matrix
+# cost matrix entry label format: tip1 start, tip1 end, tip2 start, tip2 end, ..., dlo end, dlo end
+def build_cost_matrix (tip_pos, tip_dir, w_e, w_c):
+    num_tips = len(tip_pos)
+    matrix_size = num_tips + 2
+    idx_a, idx_b = np.meshgrid(np.arange(num_tips), np.arange(num_tips), indexing='ij')
+
+    # the last two rows and columns hold the cost for being the dlo's two ends
+    cost_matrix = np.full((matrix_size, matrix_size), 1000.0)
+    cost_matrix[:num_tips, :num_tips] = compute_cost(tip_pos, tip_dir, idx_a.ravel(), idx_b.ravel(), w_e, w_c).reshape(num_tips, num_tips)
+
+    # two types of matches should be discouraged: 
+    # matching with itself and matching with the other tip on the same segment
+    #          tj_start tj_end
+    # ti_start      ...    ...
+    #   ti_end      ...    ...
+    tip_block = cost_matrix[:num_tips, :num_tips]
+    tip_block[(idx_a // 2) == (idx_b // 2)] = 100000
+    # prevent matching with itself
+    cost_matrix[matrix_size-2:matrix_size, matrix_size-2:matrix_size] = 100000
+
+    return cost_matrix
+
+# assign every tip (and the two dlo ends) to the tip it connects to
+# num_candidates = None: dense assignment over the full cost matrix
+# otherwise each tip is only linked to its num_candidates nearest tips on other chains (and to the two dlo ends)
+# and the assignment is solved on the sparse graph, which is much cheaper for masks that break into many chains.
+# the optimal link of a tip is not always among its nearest tips, so the result can be slightly worse than the dense
+# assignment (on a synthetic multi chain frame: total cost 4070.8 against 4053.9). falls back to the dense assignment
+# if the candidate graph does not admit a full matching, or if scipy is older than 1.6.0
+def match_tips (tip_pos, tip_dir, w_e, w_c, num_candidates=None):
+    num_tips = len(tip_pos)
+    if num_candidates is None or num_candidates + 2 >= num_tips:
+        return linear_sum_assignment(build_cost_matrix(tip_pos, tip_dir, w_e, w_c))
+
+    from scipy.sparse import coo_matrix
+    try:
+        # scipy >= 1.6.0
+        from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+    except ImportError:
+        print('Sparse tip matching needs scipy >= 1.6.0, falling back to the dense cost matrix.')
+        return linear_sum_assignment(build_cost_matrix(tip_pos, tip_dir, w_e, w_c))
+
+    # +2 leaves room for the tip itself and the other tip on the same chain
+    _, neighbors = cKDTree(tip_pos).query(tip_pos, k=num_candidates+2)
+    idx_a = np.repeat(np.arange(num_tips), num_candidates+2)
+    idx_b = neighbors.ravel()
+    valid = (idx_a // 2) != (idx_b // 2)
+    # linking is symmetric, keep both directions of every candidate pair
+    pair_keys = np.unique(np.concatenate((idx_a[valid] * num_tips + idx_b[valid], idx_b[valid] * num_tips + idx_a[valid])))
+    idx_a, idx_b = pair_keys // num_tips, pair_keys % num_tips
+
+    tips = np.arange(num_tips)
+    ends = np.array([num_tips, num_tips+1])
+    rows = np.concatenate((idx_a, np.repeat(tips, 2), np.tile(ends, num_tips), np.repeat(ends, 2)))
+    cols = np.concatenate((idx_b, np.tile(ends, num_tips), np.repeat(tips, 2), np.tile(ends, 2)))
+    weights = np.concatenate((compute_cost(tip_pos, tip_dir, idx_a, idx_b, w_e, w_c), np.full(4*num_tips, 1000.0), np.full(4, 100000.0)))
+
+    # every full matching has the same number of edges, so shifting all weights keeps the optimum
+    # and avoids zero weights, which sparse graphs treat as missing edges
+    graph = coo_matrix((weights + 1, (rows, cols)), shape=(num_tips+2, num_tips+2)).tocsr()
+    try:
+        return min_weight_full_bipartite_matching(graph)
+    except ValueError:
+        print('Sparse tip candidates do not admit a full matching, falling back to the dense cost matrix.')
+        return linear_sum_assignment(build_cost_matrix(tip_pos, tip_dir, w_e, w_c))
+
+# mask smoothing performed before skeletonization. available methods:
+#   mode:   PIL mode filter, the most frequent value in a size*size box
+#   median: OpenCV median blur. on a binary mask the median is the majority value, so away from the image border this
+#           matches mode at a fraction of the cost. the two pad the border differently, so within about size/2 pixels
+#           of the image edge the results can differ
+#   morph:  OpenCV morphological opening followed by closing with a size*size elliptical kernel. the opening kernel is
+#           kept below half the dlo's pixel width (see estimate_pixel_width), so it only removes speckles and never
+#           the dlo itself
+def smooth_mask (mask, method='mode', size=15):
+    if method == 'mode':
+        return np.array(Image.fromarray(mask).filter(ImageFilter.ModeFilter(size=size)))
+    elif method == 'median':
+        return cv2.medianBlur(mask, size)
+    elif method == 'morph':
+        # an opening deletes everything thinner than its kernel
+        pixel_width = estimate_pixel_width(mask if mask.ndim == 2 else mask[:, :, 0])
+        open_size = min(size, int(pixel_width / 2) // 2 * 2 + 1)
+        if open_size >= 3:
+            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (open_size, open_size))
+            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size))
+        return cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
     else:
-        # treat the second chain as needing to be reversed
-        cost_euclidean = np.linalg.norm(chain1[-1] - chain2[-1])
-        cost_curvature_1 = np.arccos(np.dot(chain2[-1] - chain1[-1], chain1[-1] - chain1[-2]) / (np.linalg.norm(chain1[-1] - chain1[-2]) * cost_euclidean))
-        cost_curvature_2 = np.arccos(np.dot(chain2[-1] - chain1[-1], chain2[-2] - chain2[-1]) / (np.linalg.norm(chain2[-1] - chain2[-2]) * cost_euclidean))
-        total_cost = w_e * cost_euclidean + w_c * (np.abs(cost_curvature_1) + np.abs(cost_curvature_2)) / 2.0
-    
-    if total_cost is np.nan or cost_curvature_1 is np.nan or cost_curvature_2 is np.nan:
-        print('total cost is nan!')
-        print('chain1 =', chain1)
-        print('chain2 =', chain2)
-        print('euclidean cost = {}, w_e*cost = {}; curvature cost = {}, w_c*cost = {}'.format(cost_euclidean, w_e*cost_euclidean, (np.abs(cost_curvature_1) + np.abs(cost_curvature_2)) / 2.0, w_c * (np.abs(cost_curvature_1) + np.abs(cost_curvature_2)) / 2.0))
-    return total_cost
+        raise ValueError('Unknown mask smoothing method: {}'.format(method))
+
+# padded bounding box (x_min, y_min, x_max, y_max) of all connected components in a one channel mask
+# that have at least min_area pixels. x_max and y_max are exclusive. returns None if there are no such components
+def mask_bounding_box (mask, padding=20, min_area=1):
+    _, _, stats, _ = cv2.connectedComponentsWithStats((mask > 0).astype(np.uint8))
+    stats = stats[1:]  # label 0 is the background
+    stats = stats[stats[:, cv2.CC_STAT_AREA] >= min_area]
+    if len(stats) == 0:
+        return None
+
+    x_min = max(np.min(stats[:, cv2.CC_STAT_LEFT]) - padding, 0)
+    y_min = max(np.min(stats[:, cv2.CC_STAT_TOP]) - padding, 0)
+    x_max = min(np.max(stats[:, cv2.CC_STAT_LEFT] + stats[:, cv2.CC_STAT_WIDTH]) + padding, mask.shape[1])
+    y_max = min(np.max(stats[:, cv2.CC_STAT_TOP] + stats[:, cv2.CC_STAT_HEIGHT]) + padding, mask.shape[0])
+    return int(x_min), int(y_min), int(x_max), int(y_max)
+
+# approximate dlo width in pixels from a one channel mask.
+# the perimeter of a thin ribbon is about twice its length, so width = 2 * area / perimeter
+def estimate_pixel_width (mask, min_area=100):
+    contours, _ = cv2.findContours((mask > 0).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[-2:]
+    area = 0
+    perimeter = 0
+    for contour in contours:
+        c_area = cv2.contourArea(contour)
+        if c_area >= min_area:
+            area += c_area
+            perimeter += cv2.arcLength(contour, True)
+    if perimeter == 0:
+        return 0
+    return 2 * area / perimeter
+
+# downsampling factor for skeleton extraction that keeps the dlo at least min_width pixels wide
+def select_img_scale (pixel_width, min_width=5):
+    return max(1, int(pixel_width // min_width))
+
+# map chains extracted at img_scale back to full resolution and refine them on the full resolution (one channel) mask:
+#   every point is moved to the middle of the dlo along the chain's normal direction,
+#   the two outer tips are moved along the chain direction to where the full resolution skeleton would end
+# chains are expected in order, as returned by extract_connected_skeleton
+def refine_chains (chains, mask, img_scale, pixel_width):
+    chain_sizes = [len(chain) for chain in chains]
+    # centers of the coarse pixels in full resolution pixel coordinates
+    pts = (np.array([pt for chain in chains for pt in chain], dtype=float) + 0.5) * img_scale - 0.5
+    directions = np.vstack([np.gradient(chain_pts, axis=0) for chain_pts in np.split(pts, np.cumsum(chain_sizes)[:-1])])
+    directions /= np.maximum(np.linalg.norm(directions, axis=1), 1e-9)[:, None]
+    normals = np.vstack((-directions[:, 1], directions[:, 0])).T
+
+    def sample_mask (origins, steps, offsets):
+        sample_pts = np.rint(origins[:, None, :] + offsets[None, :, None] * steps[:, None, :]).astype(int)
+        inside = (sample_pts[:, :, 0] >= 0) & (sample_pts[:, :, 0] < mask.shape[1]) & (sample_pts[:, :, 1] >= 0) & (sample_pts[:, :, 1] < mask.shape[0])
+        on = np.zeros(inside.shape, dtype=bool)
+        on[inside] = mask[sample_pts[:, :, 1][inside], sample_pts[:, :, 0][inside]] > 0
+        return on
+
+    # number of consecutive on samples from the first one (all of them if there is no off sample)
+    def run_length (on):
+        return np.where(np.any(~on, axis=1), np.argmax(~on, axis=1), on.shape[1])
+
+    # centering: the run of mask pixels through each point along its normal
+    radius = int(np.ceil(pixel_width)) + img_scale
+    on = sample_mask(pts, normals, np.arange(-radius, radius+1))
+    left = run_length(on[:, radius::-1])
+    right = run_length(on[:, radius:])
+    # points off the mask, or whose run is not bounded (crossings, blobs), are left as they are
+    centered = on[:, radius] & (left <= radius) & (right <= radius)
+    pts[centered] += ((right - left) / 2.0)[centered, None] * normals[centered]
+
+    # tips: the skeleton ends about half a width before the end of the mask
+    tip_idx = np.array([0, len(pts)-1])
+    tip_dirs = np.vstack((-directions[0], directions[-1]))
+    max_extension = 2*radius
+    extension = run_length(sample_mask(pts[tip_idx], tip_dirs, np.arange(0, max_extension+1)))
+    extension = np.clip(extension - 1 - pixel_width/2.0, 0, max_extension)
+    pts[tip_idx] += extension[:, None] * tip_dirs
+
+    pts = np.rint(pts).astype(int)
+    pts[:, 0] = np.clip(pts[:, 0], 0, mask.shape[1]-1)
+    pts[:, 1] = np.clip(pts[:, 1], 0, mask.shape[0]-1)
+    return [chain_pts.tolist() for chain_pts in np.split(pts, np.cumsum(chain_sizes)[:-1])]
 
 # partial implementation of paper "Deformable One-Dimensional Object Detection for Routing and Manipulation"
 # paper link: https://ieeexplore.ieee.org/abstract/document/9697357
-def extract_connected_skeleton (visualize_process, mask, img_scale=10, seg_length=3, max_curvature=30):  # note: mask is one channel
-
-    # smooth image
-    im = Image.fromarray(mask)
-    smoothed_im = im.filter(ImageFilter.ModeFilter(size=15))
-    mask = np.array(smoothed_im)
+def extract_connected_skeleton (visualize_process, mask, img_scale=10, seg_length=3, max_curvature=30, num_candidates=None, smoothing='mode', smoothing_size=15):  # note: mask is one channel
 
     # resize if necessary for better skeletonization performance
     mask = cv2.resize(mask, (int(mask.shape[1]/img_scale), int(mask.shape[0]/img_scale)))
 
+    # smooth image, at the working resolution with a correspondingly smaller (odd) filter size
+    mask = smooth_mask(mask, smoothing, max(3, int(smoothing_size/img_scale) // 2 * 2 + 1))
+
     if visualize_process:
         cv2.imshow('init frame', mask)
         while True:
@@ -274,64 +450,48 @@ def extract_connected_skeleton (visualize_process, mask, img_scale=10, seg_lengt
                 break
 
     # another pruning method
-    all_chain_length = []
-    line_seg_to_rect_dict = {}
+    # repeatedly take the longest remaining chain and trim every segment of the other chains that overlaps it.
+    # segments are kept as numpy arrays and tested in one batch through a uniform grid over the current chain
     rect_width = 3
-    for chain in chains:
-        all_chain_length.append(np.sum(np.sqrt(np.sum(np.square(np.diff(np.array(chain), axis=0)), axis=1))))
-        for i in range (0, len(chain)-1):
-            line_seg_to_rect_dict[(tuple(chain[i]), tuple(chain[i+1]))] = \
-                build_rect(Point_2D(chain[i][0], chain[i][1]), Point_2D(chain[i+1][0], chain[i+1][1]), rect_width)
-
-    all_chain_length = np.array(all_chain_length)
-    sorted_idx = np.argsort(all_chain_length.copy())
-    chains = np.asarray(chains, dtype=list)
-    sorted_chains = chains[sorted_idx]
+    remaining_chains = [np.array(chain) for chain in chains]
+    remaining_length = [chain_length(chain) for chain in remaining_chains]
 
     pruned_chains = []
-    for i in range (0, len(chains)):
+    while len(remaining_chains) != 0:
+        cur_idx = int(np.argmax(remaining_length))
+        cur_chain = remaining_chains.pop(cur_idx)
+        remaining_length.pop(cur_idx)
+        pruned_chains.append(cur_chain.tolist())
+
+        if len(remaining_chains) == 0:
+            break
+
+        # all segments of all other chains, tested against all segments in the current chain at once
+        num_segs = np.array([len(chain)-1 for chain in remaining_chains])
+        test_rects = build_rects(np.vstack([chain[:-1] for chain in remaining_chains]).astype(float),
+                                 np.vstack([chain[1:] for chain in remaining_chains]).astype(float), rect_width)
+        cur_rects = build_rects(cur_chain[:-1].astype(float), cur_chain[1:].astype(float), rect_width)
+        overlap = find_overlapping_rects(test_rects, cur_rects)
+
         leftover_chains = []
-        cur_chain = sorted_chains[-1]
-        chains_to_check = []
-
-        for j in range (0, len(sorted_chains)-1):  # -1 because the last one is cur_chain
-            test_chain = sorted_chains[j]
-            new_test_chain = []
-            for l in range (0, len(test_chain)-1):
-                rect_test_seg = line_seg_to_rect_dict[(tuple(test_chain[l]), tuple(test_chain[l+1]))]
-                # check against all segments in the current chain
-                no_overlap = True
-                for k in range (0, len(cur_chain)-1):
-                    rect_cur_seg = line_seg_to_rect_dict[(tuple(cur_chain[k]), tuple(cur_chain[k+1]))]
-                    if check_rect_overlap(rect_cur_seg, rect_test_seg):
-                        no_overlap = False
-                        break
-                # only keep the segment in the test chain if it does not overlap with any segments in the current chain
-                if no_overlap:
-                    if len(new_test_chain) == 0:
-                        new_test_chain.append(test_chain[l])
-                        new_test_chain.append(test_chain[l+1])
-                    else:
-                        new_test_chain.append(test_chain[l+1])
+        leftover_length = []
+        for test_chain, test_length, test_overlap in zip(remaining_chains, remaining_length, np.split(overlap, np.cumsum(num_segs)[:-1])):
+            if not np.any(test_overlap):
+                leftover_chains.append(test_chain)
+                leftover_length.append(test_length)
+                continue
+            # only keep the segments in the test chain that do not overlap with any segments in the current chain.
+            # the first kept segment contributes both of its points, every following one only its end point
+            kept_segs = np.flatnonzero(~test_overlap)
+            if len(kept_segs) == 0:
+                continue
+            new_test_chain = test_chain[np.concatenate(([kept_segs[0]], kept_segs + 1))]
             # finally, add trimmed test chain back into the pile for checking in the next loop
             leftover_chains.append(new_test_chain)
-        
-        # added current chain into pruned chains
-        if len(cur_chain) != 0:
-            pruned_chains.append(cur_chain)
-
-        # reinitialize sorted chains
-        all_chain_length = []
-        for chain in leftover_chains:
-            if len(chain) != 0:
-                all_chain_length.append(np.sum(np.sqrt(np.sum(np.square(np.diff(np.array(chain), axis=0)), axis=1))))
-            else:
-                all_chain_length.append(0)
+            leftover_length.append(chain_length(new_test_chain))
 
-        all_chain_length = np.array(all_chain_length)
-        sorted_idx = np.argsort(all_chain_length.copy())
-        leftover_chains = np.asarray(leftover_chains, dtype=list)
-        sorted_chains = leftover_chains[sorted_idx]
+        remaining_chains = leftover_chains
+        remaining_length = leftover_length
 
     print('Finished pruning. Merging remaining chains...')
     
@@ -348,47 +508,18 @@ def extract_connected_skeleton (visualize_process, mask, img_scale=10, seg_lengt
                 cv2.destroyAllWindows()
                 break
 
-    if len(pruned_chains) == 1:
+    # nothing left of the mask after smoothing and skeletonization
+    if len(pruned_chains) <= 1:
         return pruned_chains
 
     # total number of possible matches = number of ends * (number of ends - 2) / 2 = 2*len(chains) * (len(chains) - 1)
     # cost matrix size: num of tips + 2
     # cost matrix entry label format: tip1 start, tip1 end, tip2 start, tip2 end, ...
     matrix_size = 2*len(pruned_chains) + 2
-    cost_matrix = np.zeros((matrix_size, matrix_size))
     w_e = 0.001
     w_c = 1
-    for i in range (0, len(pruned_chains)):
-        for j in range (0, len(pruned_chains)):
-            # two types of matches should be discouraged: 
-            # matching with itself and matching with the other tip on the same segment
-            #          tj_start tj_end
-            # ti_start      ...    ...
-            #   ti_end      ...    ...
-            if i == j:
-                cost_matrix[2*i, 2*j] = 100000
-                cost_matrix[2*i, 2*j+1] = 100000
-                cost_matrix[2*i+1, 2*j] = 100000
-                cost_matrix[2*i+1, 2*j+1] = 100000
-            else:
-                # ti_start to tj_start
-                cost_matrix[2*i, 2*j] = compute_cost(pruned_chains[i], pruned_chains[j], w_e, w_c, 0)
-                # ti_start to tj_end
-                cost_matrix[2*i, 2*j+1] = compute_cost(pruned_chains[i], pruned_chains[j], w_e, w_c, 1)
-                # ti_end to tj_start
-                cost_matrix[2*i+1, 2*j] = compute_cost(pruned_chains[i], pruned_chains[j], w_e, w_c, 2)
-                # ti_end to ti_end
-                cost_matrix[2*i+1, 2*j+1] = compute_cost(pruned_chains[i], pruned_chains[j], w_e, w_c, 3)
-    
-    # cost for being the dlo's two ends
-    cost_matrix[:, -1] = 1000
-    cost_matrix[:, -2] = 1000
-    cost_matrix[-1, :] = 1000
-    cost_matrix[-2, :] = 1000
-    # prevent matching with itself
-    cost_matrix[matrix_size-2:matrix_size, matrix_size-2:matrix_size] = 100000
-
-    row_idx, col_idx = linear_sum_assignment(cost_matrix)
+    tip_pos, tip_dir = extract_tips(pruned_chains)
+    row_idx, col_idx = match_tips(tip_pos, tip_dir, w_e, w_c, num_candidates)
     cur_idx = col_idx[row_idx[-1]]
     ordered_chains = []
 
@@ -452,82 +583,118 @@ def extract_connected_skeleton (visualize_process, mask, img_scale=10, seg_lengt
 
     return ordered_chains
 
-# original post: https://stackoverflow.com/a/59204638
-def rotation_matrix_from_vectors(vec1, vec2):
-    """ Find the rotation matrix that aligns vec1 to vec2
-    :param vec1: A 3d "source" vector
-    :param vec2: A 3d "destination" vector
-    :return mat: A transform matrix (3x3) which when applied to vec1, aligns it with vec2.
-    """
-    a, b = (vec1 / np.linalg.norm(vec1)).reshape(3), (vec2 / np.linalg.norm(vec2)).reshape(3)
-    v = np.cross(a, b)
-    c = np.dot(a, b)
-    s = np.linalg.norm(v)
-    kmat = np.array([[0, -v[2], v[1]], [v[2], 0, -v[0]], [-v[1], v[0], 0]])
-    rotation_matrix = np.eye(3) + kmat + kmat.dot(kmat) * ((1 - c) / (s ** 2))
-    return rotation_matrix
-
+# distance (pixels) from each node pixel (us[i], vs[i]) to the nearest nonzero mask pixel, capped at max_dis.
+# same values as reading ndimage.distance_transform_edt(255 - mask) at the node pixels below max_dis, but only the
+# (2*ceil(max_dis)+1)^2 window around every node is read, so the cost does not depend on the image size
+def node_mask_distances (mask, us, vs, max_dis):
+    r = int(np.ceil(max_dis))
+    offsets = np.arange(-r, r+1)
+    dis_grid = np.sqrt(np.square(offsets)[:, None] + np.square(offsets)[None, :])
+
+    # M*(2r+1)*(2r+1) windows, pixels outside the image count as background
+    rows = np.asarray(vs)[:, None, None] + offsets[None, :, None]
+    cols = np.asarray(us)[:, None, None] + offsets[None, None, :]
+    inside = (rows >= 0) & (rows < mask.shape[0]) & (cols >= 0) & (cols < mask.shape[1])
+    windows = mask[np.clip(rows, 0, mask.shape[0]-1), np.clip(cols, 0, mask.shape[1]-1)]
+    on_mask = inside & (windows != 0)
+
+    dis = np.min(np.where(on_mask, dis_grid[None, :, :], np.inf), axis=(1, 2))
+    return np.minimum(dis, max_dis)
+
+# quaternions (x, y, z, w) of the minimal rotations aligning the z axis with each of the N*3 vectors
+# (the same rotations as the rotation matrix from https://stackoverflow.com/a/59204638, for all vectors at once)
+def quaternions_from_z_axis (vecs):
+    vecs = vecs / np.linalg.norm(vecs, axis=1)[:, None]
+    # rotation axis z x v, with w = 1 + z . v (half angle form)
+    quats = np.vstack((-vecs[:, 1], vecs[:, 0], np.zeros(len(vecs)), 1 + vecs[:, 2])).T
+    # v pointing along -z: any axis perpendicular to z works, use x
+    opposite = quats[:, 3] < 1e-9
+    quats[opposite] = [1, 0, 0, 0]
+    return quats / np.linalg.norm(quats, axis=1)[:, None]
+
+# node and edge markers of a node set, reusing the marker objects between frames
+# mode:
+#   'list':       one SPHERE_LIST marker for all nodes and one LINE_STRIP marker for all edges
+#   'individual': one SPHERE marker per node and one CYLINDER marker per edge
+class NodeMarkers:
+    def __init__ (self, marker_frame, node_color, line_color, mode='list', node_scale=0.01, line_scale=0.005):
+        self.marker_frame = marker_frame
+        self.node_color = node_color
+        self.line_color = line_color
+        self.mode = mode
+        self.node_scale = node_scale
+        self.line_scale = line_scale
+        self.results = None
+        self.num_of_nodes = 0
+
+    def new_marker (self, marker_type, ns, id, scale, color):
+        # imported here so the rest of this module can be used without ROS
+        from visualization_msgs.msg import Marker
+
+        marker = Marker()
+        marker.header.frame_id = self.marker_frame
+        marker.type = getattr(Marker, marker_type)
+        marker.action = Marker.ADD
+        marker.ns = ns
+        marker.id = id
+        marker.pose.orientation.w = 1.0
+        marker.scale.x = scale[0]
+        marker.scale.y = scale[1]
+        marker.scale.z = scale[2]
+        marker.color.r = color[0]
+        marker.color.g = color[1]
+        marker.color.b = color[2]
+        marker.color.a = color[3]
+        return marker
+
+    # (re)create all marker objects for num_of_nodes nodes
+    def build (self, num_of_nodes):
+        from visualization_msgs.msg import MarkerArray
+        from geometry_msgs.msg import Point
+
+        self.results = MarkerArray()
+        self.num_of_nodes = num_of_nodes
+        if self.mode == 'list':
+            node_marker = self.new_marker('SPHERE_LIST', 'node_results', 0, [self.node_scale]*3, self.node_color)
+            node_marker.points = [Point() for i in range (0, num_of_nodes)]
+            line_marker = self.new_marker('LINE_STRIP', 'line_results', 0, [self.line_scale, 0, 0], self.line_color)
+            # the line strip shares the point objects with the sphere list
+            line_marker.points = node_marker.points
+            self.results.markers = [node_marker, line_marker]
+        elif self.mode == 'individual':
+            for i in range (0, num_of_nodes):
+                self.results.markers.append(self.new_marker('SPHERE', "node_results" + str(i), i, [self.node_scale]*3, self.node_color))
+                if i != num_of_nodes-1:
+                    self.results.markers.append(self.new_marker('CYLINDER', "line_results" + str(i), i, [self.line_scale, self.line_scale, 0], self.line_color))
+        else:
+            raise ValueError('Unknown marker mode: {}'.format(self.mode))
+
+    def update (self, Y):
+        if self.results is None or len(Y) != self.num_of_nodes:
+            self.build(len(Y))
+
+        Y = np.asarray(Y, dtype=float)
+        if self.mode == 'list':
+            for point, y in zip(self.results.markers[0].points, Y.tolist()):
+                point.x, point.y, point.z = y
+            return self.results
+
+        # nodes at even indices, edges in between
+        for marker, y in zip(self.results.markers[0::2], Y.tolist()):
+            marker.pose.position.x, marker.pose.position.y, marker.pose.position.z = y
+
+        if len(Y) > 1:
+            seg = np.diff(Y, axis=0)
+            seg_len = np.linalg.norm(seg, axis=1)
+            midpoints = ((Y[:-1] + Y[1:]) / 2).tolist()
+            quats = quaternions_from_z_axis(seg).tolist()
+            for marker, midpoint, quat, length in zip(self.results.markers[1::2], midpoints, quats, seg_len.tolist()):
+                marker.pose.position.x, marker.pose.position.y, marker.pose.position.z = midpoint
+                marker.pose.orientation.x, marker.pose.orientation.y, marker.pose.orientation.z, marker.pose.orientation.w = quat
+                marker.scale.z = length
+
+        return self.results
+
+# one SPHERE marker per node and one CYLINDER marker per edge
 def ndarray2MarkerArray (Y, marker_frame, node_color, line_color):
-    results = MarkerArray()
-    for i in range (0, len(Y)):
-        cur_node_result = Marker()
-        cur_node_result.header.frame_id = marker_frame
-        cur_node_result.type = Marker.SPHERE
-        cur_node_result.action = Marker.ADD
-        cur_node_result.ns = "node_results" + str(i)
-        cur_node_result.id = i
-
-        cur_node_result.pose.position.x = Y[i, 0]
-        cur_node_result.pose.position.y = Y[i, 1]
-        cur_node_result.pose.position.z = Y[i, 2]
-        cur_node_result.pose.orientation.w = 1.0
-        cur_node_result.pose.orientation.x = 0.0
-        cur_node_result.pose.orientation.y = 0.0
-        cur_node_result.pose.orientation.z = 0.0
-
-        cur_node_result.scale.x = 0.01
-        cur_node_result.scale.y = 0.01
-        cur_node_result.scale.z = 0.01
-        cur_node_result.color.r = node_color[0]
-        cur_node_result.color.g = node_color[1]
-        cur_node_result.color.b = node_color[2]
-        cur_node_result.color.a = node_color[3]
-
-        results.markers.append(cur_node_result)
-
-        if i == len(Y)-1:
-            break
-
-        cur_line_result = Marker()
-        cur_line_result.header.frame_id = marker_frame
-        cur_line_result.type = Marker.CYLINDER
-        cur_line_result.action = Marker.ADD
-        cur_line_result.ns = "line_results" + str(i)
-        cur_line_result.id = i
-
-        cur_line_result.pose.position.x = ((Y[i] + Y[i+1])/2)[0]
-        cur_line_result.pose.position.y = ((Y[i] + Y[i+1])/2)[1]
-        cur_line_result.pose.position.z = ((Y[i] + Y[i+1])/2)[2]
-
-        rot_matrix = rotation_matrix_from_vectors(np.array([0, 0, 1]), (Y[i+1]-Y[i])/pt2pt_dis(Y[i+1], Y[i])) 
-        r = R.from_matrix(rot_matrix)
-        x = r.as_quat()[0]
-        y = r.as_quat()[1]
-        z = r.as_quat()[2]
-        w = r.as_quat()[3]
-
-        cur_line_result.pose.orientation.w = w
-        cur_line_result.pose.orientation.x = x
-        cur_line_result.pose.orientation.y = y
-        cur_line_result.pose.orientation.z = z
-        cur_line_result.scale.x = 0.005
-        cur_line_result.scale.y = 0.005
-        cur_line_result.scale.z = pt2pt_dis(Y[i], Y[i+1])
-        cur_line_result.color.r = line_color[0]
-        cur_line_result.color.g = line_color[1]
-        cur_line_result.color.b = line_color[2]
-        cur_line_result.color.a = line_color[3]
-
-        results.markers.append(cur_line_result)
-    
-    return results
\ No newline at end of file
+    return NodeMarkers(marker_frame, node_color, line_color, mode='individual').update(Y)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# runs the initial node set computation over a directory of recorded frames, without roscore.
+# every frame is a pair of <sample_id>_rgb.png (as saved by collect_pointcloud.py) and <sample_id>_depth.png
+# (16 bit depth image in mm, aligned with the rgb image). frames are processed in parallel by a process pool
+# and the resulting nodes are saved as <sample_id>_init_nodes.npy in the output directory.
+
+import argparse
+import glob
+import os
+import sys
+import time
+from multiprocessing import Pool
+from os.path import basename, dirname, abspath, join
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'trackdlo', 'src'))
+from init_pipeline import compute_init_nodes
+from camera_model import CameraModel
+
+def init_worker ():
+    # one frame per process, opencv's own thread pool would only oversubscribe the cpus
+    cv2.setNumThreads(1)
+
+def process_frame (task):
+    rgb_file, depth_file, output_file, params = task
+    start_time = time.time()
+    try:
+        cur_image = cv2.cvtColor(cv2.imread(rgb_file), cv2.COLOR_BGR2RGB)
+        cur_depth = cv2.imread(depth_file, cv2.IMREAD_UNCHANGED)
+        init_nodes = compute_init_nodes(cur_image, cur_depth, **params)
+    except Exception as e:
+        return rgb_file, 'failed ({})'.format(e), time.time() - start_time
+
+    if init_nodes is None:
+        return rgb_file, 'no dlo found', time.time() - start_time
+
+    np.save(output_file, init_nodes)
+    return rgb_file, 'ok', time.time() - start_time
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', default=join(dirname(dirname(abspath(__file__))), 'data/'))
+    parser.add_argument('--output_dir', default=None, help='defaults to data_dir')
+    parser.add_argument('--proj_matrix', required=True, help='the 12 entries of the 3*4 camera projection matrix (CameraInfo.P), separated by spaces')
+    parser.add_argument('--num_of_nodes', type=int, default=45)
+    parser.add_argument('--hsv_threshold_lower_limit', default='90 90 30')
+    parser.add_argument('--hsv_threshold_upper_limit', default='130 255 255')
+    parser.add_argument('--multi_color_dlo', action='store_true')
+    parser.add_argument('--mask_smoothing', default='median')
+    parser.add_argument('--multi_scale', action='store_true')
+    parser.add_argument('--num_tip_candidates', type=int, default=0, help='nearest tips each chain tip is matched against when merging chains, 0 for the dense assignment')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    output_dir = args.data_dir if args.output_dir is None else args.output_dir
+    os.makedirs(output_dir, exist_ok=True)
+
+    params = {'camera': None,
+              'num_of_nodes': args.num_of_nodes,
+              'lower': tuple(int(val) for val in args.hsv_threshold_lower_limit.split(' ')),
+              'upper': tuple(int(val) for val in args.hsv_threshold_upper_limit.split(' ')),
+              'multi_color_dlo': args.multi_color_dlo,
+              'mask_smoothing': args.mask_smoothing,
+              'multi_scale': args.multi_scale,
+              'num_candidates': args.num_tip_candidates if args.num_tip_candidates > 0 else None}
+
+    tasks = []
+    for rgb_file in sorted(glob.glob(join(args.data_dir, '*_rgb.png'))):
+        sample_id = basename(rgb_file)[:-len('_rgb.png')]
+        depth_file = join(args.data_dir, sample_id + '_depth.png')
+        if not os.path.exists(depth_file):
+            print('Skipping', sample_id, '(no depth image)')
+            continue
+        tasks.append((rgb_file, depth_file, join(output_dir, sample_id + '_init_nodes.npy'), params))
+
+    if len(tasks) == 0:
+        print('No frames found in', args.data_dir)
+        sys.exit(1)
+
+    # all frames are expected to come from the same camera
+    height, width = cv2.imread(tasks[0][0]).shape[:2]
+    params['camera'] = CameraModel([float(val) for val in args.proj_matrix.split()], width, height)
+
+    start_time = time.time()
+    num_ok = 0
+    with Pool(args.num_workers, initializer=init_worker) as pool:
+        for rgb_file, status, time_taken in pool.imap_unordered(process_frame, tasks):
+            print('{}: {} ({:.1f} ms)'.format(basename(rgb_file), status, time_taken*1000))
+            num_ok += status == 'ok'
+
+    print('')
+    print('Initialized {} of {} frames with {} workers in {:.1f} s'.format(num_ok, len(tasks), args.num_workers, time.time() - start_time))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# compares the mask smoothing methods used before skeletonization during initialization.
+# for every recorded image (*_rgb.png, as saved by collect_pointcloud.py) the mask is smoothed with each method,
+# chains are extracted, and both the runtime and the placement of equally spaced nodes along the extracted chains
+# are reported. node placement is compared against the original PIL mode filter.
+
+import argparse
+import glob
+import sys
+import time
+from os.path import basename, dirname, abspath, join
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'trackdlo', 'src'))
+from utils import extract_connected_skeleton, smooth_mask
+
+methods = ['mode', 'median', 'morph']
+
+# equally spaced pixel positions along the extracted chains
+def resample_chains (chains, num_of_nodes):
+    pts = np.array([pt for chain in chains for pt in chain], dtype=float)
+    arc_len = np.concatenate(([0], np.cumsum(np.sqrt(np.sum(np.square(np.diff(pts, axis=0)), axis=1)))))
+    samples = np.linspace(0, arc_len[-1], num_of_nodes)
+    return np.vstack((np.interp(samples, arc_len, pts[:, 0]), np.interp(samples, arc_len, pts[:, 1]))).T
+
+# mean pixel distance between two node sets, the chain direction is arbitrary
+def node_placement_error (nodes_1, nodes_2):
+    return min(np.mean(np.linalg.norm(nodes_1 - nodes_2, axis=1)), np.mean(np.linalg.norm(nodes_1 - nodes_2[::-1], axis=1)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', default=join(dirname(dirname(abspath(__file__))), 'data/'))
+    parser.add_argument('--hsv_threshold_lower_limit', default='90 90 30')
+    parser.add_argument('--hsv_threshold_upper_limit', default='130 255 255')
+    parser.add_argument('--num_of_nodes', type=int, default=45)
+    parser.add_argument('--size', type=int, default=15, help='filter size (odd) used for both the timing and the chain extraction')
+    args = parser.parse_args()
+
+    lower = tuple(int(val) for val in args.hsv_threshold_lower_limit.split(' '))
+    upper = tuple(int(val) for val in args.hsv_threshold_upper_limit.split(' '))
+
+    image_files = sorted(glob.glob(join(args.data_dir, '*_rgb.png')))
+    if len(image_files) == 0:
+        print('No *_rgb.png images found in', args.data_dir)
+        sys.exit(1)
+
+    smoothing_time = {method: [] for method in methods}
+    extraction_time = {method: [] for method in methods}
+    placement_error = {method: [] for method in methods}
+
+    for image_file in image_files:
+        cur_image = cv2.imread(image_file)
+        hsv_image = cv2.cvtColor(cur_image, cv2.COLOR_BGR2HSV)
+        mask = cv2.cvtColor(cv2.inRange(hsv_image, lower, upper), cv2.COLOR_GRAY2BGR)
+
+        nodes = {}
+        for method in methods:
+            start_time = time.time()
+            smooth_mask(mask, method, args.size)
+            smoothing_time[method].append(time.time() - start_time)
+
+            start_time = time.time()
+            chains = extract_connected_skeleton(False, mask, img_scale=1, seg_length=8, max_curvature=25, smoothing=method, smoothing_size=args.size)
+            extraction_time[method].append(time.time() - start_time)
+            if len(chains) == 0:
+                print('{}: no chains extracted with {} smoothing'.format(basename(image_file), method))
+                continue
+            nodes[method] = resample_chains(chains, args.num_of_nodes)
+
+        for method in methods:
+            if method in nodes and 'mode' in nodes:
+                placement_error[method].append(node_placement_error(nodes[method], nodes['mode']))
+
+    print('')
+    print('{} images, {} nodes, filter size {}'.format(len(image_files), args.num_of_nodes, args.size))
+    print('{:>8} {:>16} {:>18} {:>26}'.format('method', 'smoothing (ms)', 'extraction (ms)', 'node error vs mode (px)'))
+    for method in methods:
+        print('{:>8} {:>16.2f} {:>18.2f} {:>26.2f}'.format(method, np.mean(smoothing_time[method])*1000,
+                                                             np.mean(extraction_time[method])*1000, np.mean(placement_error[method]) if len(placement_error[method]) > 0 else np.nan))
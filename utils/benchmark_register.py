@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+# measures the cost of the initial node registration (register in trackdlo/src/registration.py) against the number
+# of points. the points are sampled around a synthetic dlo shaped curve, similar to a downsampled rope point cloud.
+# for every N the runtime and the peak memory allocated by numpy during registration are reported.
+
+import argparse
+import sys
+import time
+import tracemalloc
+from os.path import dirname, abspath, join
+
+import numpy as np
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'trackdlo', 'src'))
+from registration import register
+
+# N points scattered around a planar s shaped curve of length ~0.6 m, 0.7 m in front of the camera
+def synthetic_dlo (N, noise=0.003, seed=0):
+    rng = np.random.RandomState(seed)
+    t = rng.uniform(0, 1, N)
+    pts = np.vstack((0.5*t - 0.25, 0.1*np.sin(2*np.pi*t), np.full(N, 0.7))).T
+    return pts + rng.normal(0, noise, (N, 3))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_points', default='500 1000 2000 5000 10000 20000')
+    parser.add_argument('--num_of_nodes', type=int, default=40)
+    parser.add_argument('--max_iter', type=int, default=100)
+    parser.add_argument('--mu', type=float, default=0.05)
+    parser.add_argument('--chunk_size', type=int, default=2048)
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('{} nodes, {} iterations, chunk size {}'.format(args.num_of_nodes, args.max_iter, args.chunk_size))
+    print('{:>8} {:>14} {:>18} {:>16}'.format('N', 'register (ms)', 'per iteration (ms)', 'peak mem (MB)'))
+
+    for N in [int(val) for val in args.num_points.split()]:
+        X = synthetic_dlo(N)
+
+        run_times = []
+        for i in range (0, args.repeat):
+            start_time = time.time()
+            register(X, args.num_of_nodes, args.mu, args.max_iter, args.chunk_size, args.num_threads)
+            run_times.append(time.time() - start_time)
+
+        # separate run, tracing allocations slows numpy down
+        tracemalloc.start()
+        register(X, args.num_of_nodes, args.mu, args.max_iter, args.chunk_size, args.num_threads)
+        peak_mem = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        run_time = np.median(run_times)
+        print('{:>8} {:>14.1f} {:>18.2f} {:>16.2f}'.format(N, run_time*1000, run_time*1000/(args.max_iter+1), peak_mem/1e6))
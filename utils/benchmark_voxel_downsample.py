@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# compares the numpy voxel downsampler (voxel_downsample in trackdlo/src/pointcloud.py) with open3d's voxel_down_sample.
+# runs on the point clouds recorded by collect_pointcloud.py (*_pc.json, pickled N*3 arrays) or, if there are none, on
+# synthetic clouds. reports the runtime of each backend and how far the numpy voxel centers are from open3d's.
+
+import argparse
+import glob
+import pickle as pkl
+import sys
+import time
+from os.path import dirname, abspath, join
+
+import numpy as np
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'trackdlo', 'src'))
+from pointcloud import voxel_downsample
+
+def load_clouds (data_dir, min_depth, max_depth):
+    clouds = []
+    for pc_file in sorted(glob.glob(join(data_dir, '*_pc.json'))):
+        with open(pc_file, 'rb') as f:
+            cloud = np.asarray(pkl.load(f), dtype=np.float64).reshape(-1, 3)
+        clouds.append(cloud[(cloud[:, 2] > min_depth) & (cloud[:, 2] < max_depth)])
+    return clouds
+
+def synthetic_clouds (num_clouds, num_points):
+    rng = np.random.RandomState(0)
+    return [rng.uniform([-0.5, -0.3, 0.6], [0.5, 0.3, 1.2], (num_points, 3)) for i in range (0, num_clouds)]
+
+# median runtime (s) and the output of the last run
+def time_backend (cloud, voxel_size, backend, repeat):
+    run_times = []
+    for i in range (0, repeat):
+        start_time = time.time()
+        result = voxel_downsample(cloud, voxel_size, backend)
+        run_times.append(time.time() - start_time)
+    return np.median(run_times), result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', default=join(dirname(dirname(abspath(__file__))), 'data/'))
+    parser.add_argument('--voxel_size', type=float, default=0.005)
+    parser.add_argument('--min_depth', type=float, default=0.0)
+    parser.add_argument('--max_depth', type=float, default=np.inf)
+    parser.add_argument('--num_points', type=int, default=300000, help='size of the synthetic clouds')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    clouds = load_clouds(args.data_dir, args.min_depth, args.max_depth)
+    if len(clouds) == 0:
+        print('No *_pc.json point clouds found in', args.data_dir + ', using synthetic clouds')
+        clouds = synthetic_clouds(3, args.num_points)
+
+    try:
+        import open3d
+        backends = ['numpy', 'numpy (float32)', 'open3d']
+    except ImportError:
+        print('open3d is not installed, only timing the numpy backend')
+        backends = ['numpy', 'numpy (float32)']
+
+    run_time = {backend: [] for backend in backends}
+    center_error = []
+    for cloud in clouds:
+        results = {}
+        for backend in backends:
+            if backend == 'numpy (float32)':
+                run_time[backend].append(time_backend(cloud.astype(np.float32), args.voxel_size, 'numpy', args.repeat)[0])
+            else:
+                run_time[backend].append(time_backend(cloud, args.voxel_size, backend, args.repeat)[0])
+                results[backend] = time_backend(cloud, args.voxel_size, backend, 1)[1]
+
+        if 'open3d' in results:
+            # open3d returns the voxels in hash map order, compare lexicographically sorted centers
+            numpy_pts = results['numpy'][np.lexsort(results['numpy'].T)]
+            open3d_pts = results['open3d'][np.lexsort(results['open3d'].T)]
+            if len(numpy_pts) == len(open3d_pts):
+                center_error.append(np.max(np.abs(numpy_pts - open3d_pts)))
+            else:
+                print('Voxel count differs: numpy {}, open3d {}'.format(len(numpy_pts), len(open3d_pts)))
+
+    print('')
+    print('{} clouds, {:.0f} points on average, voxel size {}'.format(len(clouds), np.mean([len(cloud) for cloud in clouds]), args.voxel_size))
+    print('{:>16} {:>12}'.format('backend', 'time (ms)'))
+    for backend in backends:
+        print('{:>16} {:>12.2f}'.format(backend, np.mean(run_time[backend])*1000))
+    if len(center_error) > 0:
+        print('max voxel center difference numpy vs open3d: {:.3g} m'.format(np.max(center_error)))
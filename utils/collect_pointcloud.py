@@ -26,6 +26,7 @@ cur_pc = []
 cur_image_arr = []
 cur_result = []
 cur_tracking_image_arr = []
+cur_depth_arr = []
 
 # this gives pcl in the camera's frame
 def update_cur_pc(data):
@@ -43,6 +44,10 @@ def update_img(data):
     cur_image = ros_numpy.numpify(data)
     cur_image_arr = cv2.cvtColor(cur_image, cv2.COLOR_BGR2RGB)
 
+def update_depth(data):
+    global cur_depth_arr
+    cur_depth_arr = ros_numpy.numpify(data)
+
 def update_tracking_img(data):
     global cur_tracking_image_arr
     cur_tracking_image_arr = ros_numpy.numpify(data)
@@ -69,6 +74,7 @@ def record(main_dir, start=0, save_image=False, save_results=False):
             rospy.signal_shutdown('')
         else:
             rospy.Subscriber("/camera/color/image_raw", Image, update_img)
+            rospy.Subscriber("/camera/aligned_depth_to_color/image_raw", Image, update_depth)
             rospy.Subscriber("/tracking_img", Image, update_tracking_img)
             rospy.Subscriber("/trackdlo_results_pc", PointCloud2, update_cur_result)
             rospy.Subscriber("/camera/depth/color/points", PointCloud2, update_cur_pc)
@@ -79,6 +85,10 @@ def record(main_dir, start=0, save_image=False, save_results=False):
                     print("Could not capture image, please try again! \n")
                     continue
                 cv2.imwrite(main_dir + sample_id + "_rgb.png", cur_image_arr)
+
+                # 16 bit depth in mm, used by batch_initialize.py
+                if len(cur_depth_arr) != 0:
+                    cv2.imwrite(main_dir + sample_id + "_depth.png", cur_depth_arr)
             
             if save_results:
                 if len(cur_result) == 0:
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# replays recorded frames through the tracking pipeline of tracking_test.py (segmentation -> point extraction ->
+# downsampling -> register on the first frame, cpd_lle after that) without roscore, as fast as possible.
+# frames are the <sample_id>_rgb.png and <sample_id>_pc.json files written by collect_pointcloud.py, in sample_id order.
+# reports frames per second, per stage latency, and how far the tracked nodes drift from the nodes saved by an earlier
+# run (--save_nodes / --reference), so performance changes can be checked for accuracy too.
+
+import argparse
+import glob
+import pickle as pkl
+import sys
+import time
+from os.path import basename, dirname, abspath, join
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'trackdlo', 'src'))
+from camera_model import CameraModel
+from pointcloud import MaskedPointExtractor, voxel_downsample
+from registration import register, sort_pts, cpd_lle, CpdLleState
+from timing import Timer
+
+# same color thresholds as tracking_test.py (use_eval_rope)
+def segment (cur_image):
+    hsv_image = cv2.cvtColor(cur_image, cv2.COLOR_RGB2HSV)
+
+    # --- rope blue ---
+    mask_dlo = cv2.inRange(hsv_image, (90, 60, 40), (130, 255, 255))
+
+    # --- tape red ---
+    mask_red_1 = cv2.inRange(hsv_image, (130, 60, 40), (255, 255, 255))
+    mask_red_2 = cv2.inRange(hsv_image, (0, 60, 40), (10, 255, 255))
+
+    return cv2.bitwise_or(mask_dlo, cv2.bitwise_or(mask_red_1, mask_red_2))
+
+def load_frames (data_dir):
+    frames = []
+    for rgb_file in sorted(glob.glob(join(data_dir, '*_rgb.png'))):
+        sample_id = basename(rgb_file)[:-len('_rgb.png')]
+        try:
+            with open(join(data_dir, sample_id + '_pc.json'), 'rb') as f:
+                cloud = np.asarray(pkl.load(f), dtype=np.float64).reshape(-1, 3)
+        except FileNotFoundError:
+            print('Skipping', sample_id, '(no point cloud)')
+            continue
+
+        # collect_pointcloud.py saves the images in bgr order
+        cur_image = cv2.cvtColor(cv2.imread(rgb_file), cv2.COLOR_BGR2RGB)
+        frames.append((sample_id, cur_image, cloud))
+
+    return frames
+
+# runs the whole sequence once with a fresh tracker. returns the tracked nodes of every frame (F*M*3)
+def run_sequence (frames, args, camera, timer):
+    point_extractor = MaskedPointExtractor(min_depth=args.min_depth)
+    cpd_lle_state = CpdLleState(k=6, node_tol=args.node_tol)
+    nodes = None
+    sigma2 = 0
+
+    all_nodes = []
+    for sample_id, cur_image, cloud in frames:
+        frame_start_time = time.perf_counter()
+        timings = {}
+
+        with timer.span('segmentation', timings):
+            mask = segment(cur_image)
+
+        with timer.span('extraction', timings):
+            if len(cloud) == mask.size:
+                filtered_pc = point_extractor.extract(cloud, mask)
+            else:
+                # the recorded cloud lost its image layout (nan points removed), look the points up in the mask instead.
+                # the points come from pixel centers, so they are rounded to the nearest pixel. points that project
+                # outside the image are dropped
+                us, vs = camera.project(cloud)
+                us = np.rint(us)
+                vs = np.rint(vs)
+                inside = (cloud[:, 2] > args.min_depth) & (us >= 0) & (us < camera.width) & (vs >= 0) & (vs < camera.height)
+                cloud_inside = cloud[inside]
+                filtered_pc = cloud_inside[mask[vs[inside].astype(int), us[inside].astype(int)] != 0]
+
+        with timer.span('downsampling', timings):
+            filtered_pc = voxel_downsample(filtered_pc, args.voxel_size)
+
+        if nodes is None:
+            with timer.span('registration', timings):
+                nodes, sigma2 = register(filtered_pc, args.num_of_nodes, 0.05, max_iter=100)
+                nodes = sort_pts(nodes)
+
+        with timer.span('tracking_step', timings):
+            nodes, sigma2, cpd_info = cpd_lle(filtered_pc, nodes, 0.7, 5, 1, 0.05, 50, 0.00001, True, False, False, sigma2, state=cpd_lle_state,
+                                              deadline_ms=args.deadline_ms, return_info=True, truncate=args.truncate)
+        timer.add('e_step', cpd_info['e_step_time'], timings)
+        timer.add('m_step', cpd_info['m_step_time'], timings)
+        timer.add('total', time.perf_counter() - frame_start_time, timings)
+        timer.add_record(timings)
+
+        all_nodes.append(nodes.copy())
+
+    return np.array(all_nodes)
+
+# per frame max node distance between two runs (m)
+def node_drift (nodes_1, nodes_2):
+    return np.max(np.linalg.norm(nodes_1 - nodes_2, axis=2), axis=1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', default=join(dirname(dirname(abspath(__file__))), 'data/'))
+    parser.add_argument('--proj_matrix', default=None, help='the 12 entries of the 3*4 camera projection matrix (CameraInfo.P), separated by spaces. only needed for clouds that are not organized')
+    parser.add_argument('--min_depth', type=float, default=0.58)
+    parser.add_argument('--voxel_size', type=float, default=0.005)
+    parser.add_argument('--num_of_nodes', type=int, default=40)
+    parser.add_argument('--node_tol', type=float, default=0.0, help='node motion (m) before cpd_lle recomputes its cached matrices, 0 for the exact step')
+    parser.add_argument('--truncate', type=float, default=4.0, help='sparse E-step radius in standard deviations, negative for the dense E-step')
+    parser.add_argument('--deadline_ms', type=float, default=None, help='tracking step budget. results then depend on timing, leave unset to compare accuracy')
+    parser.add_argument('--runs', type=int, default=3, help='number of times the sequence is replayed for timing')
+    parser.add_argument('--save_nodes', default=None, help='save the nodes of the first run (.npy)')
+    parser.add_argument('--reference', default=None, help='nodes saved by an earlier run (.npy) to compare against')
+    parser.add_argument('--timing_record_file', default=None, help='per frame timings of all runs (.csv or .json)')
+    args = parser.parse_args()
+
+    if args.truncate < 0:
+        args.truncate = None
+
+    frames = load_frames(args.data_dir)
+    if len(frames) == 0:
+        print('No frames (*_rgb.png with *_pc.json) found in', args.data_dir)
+        sys.exit(1)
+
+    camera = None
+    if args.proj_matrix is not None:
+        height, width = frames[0][1].shape[:2]
+        camera = CameraModel([float(val) for val in args.proj_matrix.split()], width, height)
+    elif any(len(cloud) != cur_image.shape[0]*cur_image.shape[1] for sample_id, cur_image, cloud in frames):
+        print('Some point clouds are not organized, --proj_matrix is needed to match them with the images')
+        sys.exit(1)
+
+    timer = Timer(keep_records=args.timing_record_file is not None)
+    run_times = []
+    for run in range (0, args.runs):
+        start_time = time.perf_counter()
+        tracked_nodes = run_sequence(frames, args, camera, timer)
+        run_times.append(time.perf_counter() - start_time)
+        print('run {}: {:.1f} fps'.format(run, len(frames) / run_times[-1]))
+
+    print('')
+    print('{} frames, {} runs, {:.1f} fps on average ({:.1f} fps best)'.format(len(frames), args.runs, len(frames) * args.runs / np.sum(run_times), len(frames) / np.min(run_times)))
+    print(timer.format_summary())
+
+    if args.reference is not None:
+        print('')
+        reference = np.load(args.reference)
+        if reference.shape != tracked_nodes.shape:
+            print('Reference nodes have shape {}, this run {}, not comparing'.format(reference.shape, tracked_nodes.shape))
+        else:
+            drift = node_drift(tracked_nodes, reference)
+            print('node drift vs reference: mean {:.3g} m, max {:.3g} m (worst frame: {})'.format(np.mean(drift), np.max(drift), frames[np.argmax(drift)][0]))
+
+    if args.save_nodes is not None:
+        np.save(args.save_nodes, tracked_nodes)
+        print('Saved nodes to', args.save_nodes)
+
+    if args.timing_record_file is not None:
+        timer.dump(args.timing_record_file)
+        print('Saved per frame timings to', args.timing_record_file)
@@ -3,7 +3,7 @@
 import matplotlib.pyplot as plt
 import rospy
 import ros_numpy
-from sensor_msgs.msg import PointCloud2, PointField, Image
+from sensor_msgs.msg import PointCloud2, PointField, Image, CameraInfo
 import sensor_msgs.point_cloud2 as pcl2
 import std_msgs.msg
 
@@ -17,10 +17,14 @@ import time
 import pickle as pkl
 
 import message_filters
-import open3d as o3d
-from scipy import ndimage
 from scipy import interpolate
 
+import sys
+from os.path import dirname, abspath, join
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'trackdlo', 'src'))
+from camera_model import CameraModel
+from utils import node_mask_distances
+
 cur_image = []
 cur_image_arr = []
 def update_rgb (data):
@@ -35,6 +39,12 @@ def update_rgb (data):
         cur_image = cur_image_arr[0]
         cur_image_arr.pop(0)
 
+camera = None
+def camera_info_callback (info):
+    global camera
+    camera = CameraModel.from_camera_info(info)
+    camera_info_sub.unregister()
+
 bmask = []
 mask = []
 def update_mask (data):
@@ -48,9 +58,8 @@ def callback (pc):
     global bmask
     global mask
 
-    proj_matrix = np.array([[918.359130859375,              0.0, 645.8908081054688, 0.0], \
-                            [             0.0, 916.265869140625,   354.02392578125, 0.0], \
-                            [             0.0,              0.0,               1.0, 0.0]])
+    if camera is None:
+        return
 
     # process point cloud
     pc_data = ros_numpy.point_cloud2.pointcloud2_to_array(pc)
@@ -59,26 +68,14 @@ def callback (pc):
 
     # determined which nodes are occluded from mask information
     mask_dis_threshold = 10
-    # projection
-    nodes_h = np.hstack((nodes, np.ones((len(nodes), 1))))
-    # proj_matrix: 3*4; nodes_h.T: 4*M; result: 3*M
-    image_coords = np.matmul(proj_matrix, nodes_h.T).T
-    us = (image_coords[:, 0] / image_coords[:, 2]).astype(int)
-    vs = (image_coords[:, 1] / image_coords[:, 2]).astype(int)
-
-    # limit the range of calculated image coordinates
-    us = np.where(us >= 1280, 1279, us)
-    vs = np.where(vs >= 720, 719, vs)
-
-    uvs = np.vstack((vs, us)).T
-    uvs_t = tuple(map(tuple, uvs.T))
+    # projection, clamped to the image for the visibility lookup
+    us, vs = camera.project_to_pixels(nodes)
 
-    # invert bmask for distance transform
-    bmask_transformed = ndimage.distance_transform_edt(255 - bmask)
-    vis = bmask_transformed[uvs_t]
+    # distance from each node pixel to the mask, capped at the threshold
+    vis = node_mask_distances(bmask, us, vs, mask_dis_threshold)
 
     tracking_img = cur_image.copy()
-    for i in range (len(image_coords)):
+    for i in range (len(nodes)):
         # draw circle
         uv = (us[i], vs[i])
         if vis[i] < mask_dis_threshold:
@@ -87,7 +84,7 @@ def callback (pc):
             cv2.circle(tracking_img, uv, 5, (255, 0, 0), -1)
 
         # draw line
-        if i != len(image_coords)-1:
+        if i != len(nodes)-1:
             if vis[i] < mask_dis_threshold:
                 cv2.line(tracking_img, uv, (us[i+1], vs[i+1]), (0, 255, 0), 2)
             else:
@@ -99,6 +96,7 @@ def callback (pc):
 if __name__=='__main__':
     rospy.init_node('cdcpd_image', anonymous=True)
 
+    camera_info_sub = rospy.Subscriber('/camera/color/camera_info', CameraInfo, camera_info_callback)
     rospy.Subscriber('/mask', Image, update_mask)
     rospy.Subscriber('/camera/color/image_raw', Image, update_rgb)
     rospy.Subscriber('/cdcpd2_no_gripper_results_pc', PointCloud2, callback)